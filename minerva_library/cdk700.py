@@ -1,5 +1,6 @@
 import urllib
 import urllib2
+import httplib
 import datetime
 import time
 import logging
@@ -19,6 +20,7 @@ import shutil
 import subprocess
 import ephem
 import utils
+from propagatingthread import PropagatingThread
 import random
 #try:
 #        import pyfits
@@ -30,7 +32,9 @@ import env
 
 from configobj import ConfigObj
 #import pwihelpers as pwi
-from xml.etree import ElementTree
+# the C parser is much faster (and is what parseXml uses)
+try: from xml.etree import cElementTree as ElementTree
+except ImportError: from xml.etree import ElementTree
 sys.dont_write_bytecode = True
 
 #HELPER CLASSES
@@ -67,8 +71,97 @@ def elementTreeToObject(elementTreeNode):
 
 	return result
 
+def elementTreeToObjectFlat(elementTreeNode):
+	"""
+	Same result as elementTreeToObject, built without recursion: every node
+	with children becomes a Status whose attributes are filled straight from
+	its children (leaves become their text), one level at a time.
+	"""
+
+	if len(elementTreeNode) == 0:
+		return elementTreeNode.text
+
+	result = Status()
+	stack = [(elementTreeNode, result)]
+	while stack:
+		node, obj = stack.pop()
+		attributes = obj.__dict__
+		for childNode in node:
+			if len(childNode) == 0:
+				attributes[childNode.tag] = childNode.text
+			else:
+				child = Status()
+				attributes[childNode.tag] = child
+				stack.append((childNode, child))
+		attributes['value'] = node.text
+
+	return result
 
 
+
+class ConnectionPool:
+	"""
+	A small pool of keep-alive HTTP connections to a single server (PWI), so
+	repeated requests don't each pay for a new TCP connection. Each request
+	borrows its own connection, so it is safe to use from multiple threads.
+	"""
+
+	def __init__(self, host, port, timeout=30.0, maxsize=4):
+		self.host = host
+		self.port = int(port)
+		self.timeout = timeout
+		self.maxsize = maxsize
+		self.idle = []
+		self.lock = threading.Lock()
+
+	def clear(self):
+		with self.lock:
+			idle = self.idle
+			self.idle = []
+		for conn in idle: conn.close()
+
+	def get(self, path, timeout=None):
+		"""
+		GET path and return the body of the response. Raises httplib.HTTPException
+		or socket.error on failure.
+		"""
+
+		if timeout == None: timeout = self.timeout
+
+		while True:
+			with self.lock:
+				if len(self.idle) > 0: conn = self.idle.pop()
+				else: conn = None
+			reused = conn != None
+			if not reused: conn = httplib.HTTPConnection(self.host, self.port, timeout=timeout)
+
+			try:
+				conn.timeout = timeout
+				if conn.sock != None: conn.sock.settimeout(timeout)
+				conn.request('GET', path)
+				response = conn.getresponse()
+				data = response.read()
+			except socket.timeout:
+				conn.close()
+				raise
+			except (httplib.HTTPException, socket.error):
+				conn.close()
+				# the server may have closed idle connections; retry on a new one
+				if reused:
+					self.clear()
+					continue
+				raise
+
+			if response.will_close:
+				conn.close()
+			else:
+				with self.lock:
+					if len(self.idle) < self.maxsize:
+						self.idle.append(conn)
+						conn = None
+				if conn != None: conn.close()
+			return data
+
 class CDK700:
 	def __init__(self, config, base='', red=False, south=False, thach=False, directory=None):
 
@@ -78,6 +171,8 @@ class CDK700:
 		self.base_directory = base
 		#S Get values from config_file
 		self.load_config()
+		# keep-alive connections to PWI
+		self.pwi = ConnectionPool(self.HOST, self.NETWORKPORT, timeout=self.pwitimeout)
                 self.thach = thach
 		self.focusMoving = False
 		self.rotatorMoving = False
@@ -107,6 +202,23 @@ class CDK700:
 		self.rotator1_lock = threading.RLock()
 		self.rotator2_lock = threading.RLock()
 
+		# cached status shared by all threads (see getStatus)
+		self.status_lock = threading.RLock()
+		self.status_cache = None
+		self.status_time = 0.0
+		self.last_command_time = 0.0
+		if self.status_period > 0:
+			thread = threading.Thread(target=self.statusPollerThread)
+			thread.daemon = True
+			thread.start()
+
+		# observer reused by radectoaltaz (only its date changes between calls)
+		self.observer_lock = threading.Lock()
+		self.observer = ephem.Observer()
+		self.observer.lat = str(self.site.latitude)
+		self.observer.long = str(self.site.longitude)
+		self.observer.elevation = self.site.elevation
+
 
 		# threading.Thread(target=self.write_status_thread).start()
 		
@@ -287,6 +399,21 @@ class CDK700:
 			except: self.minfocus = {'0':33000,'1':33000,'2':33000}
 			try: self.win10 = config['Setup']['WIN10']
 			except: self.win10 = False
+			try: self.pwitimeout = float(config['Setup']['PWITIMEOUT'])
+			except: self.pwitimeout = 30.0
+			# how often the background thread refreshes the status (0 disables it)
+			try: self.status_period = float(config['Setup']['STATUSPERIOD'])
+			except: self.status_period = 0.25
+			# default maximum age of a cached status returned by getStatus
+			try: self.status_maxage = float(config['Setup']['STATUSMAXAGE'])
+			except: self.status_maxage = 0.5
+			# fastest polling interval when waiting for a mechanism to finish a move
+			try: self.wait_mininterval = float(config['Setup']['WAITMININTERVAL'])
+			except: self.wait_mininterval = 0.2
+			# approximate focuser speed (microns/s) used to predict when a move will finish
+			# (~90 seconds from one extreme to the other)
+			try: self.focuser_speed = float(config['Setup']['FOCUSERSPEED'])
+			except: self.focuser_speed = 350.0
 			self.rotatoroffset = config['ROTATOROFFSET']
 			self.default_focus = config['DEFAULT_FOCUS']
 			self.focus_offset = config['FOCUS_OFFSET']
@@ -305,6 +432,13 @@ class CDK700:
 			try: self.focus_offset[key] = float(self.focus_offset[key])
 			except: pass
 
+		# a poller slower than STATUSMAXAGE leaves callers fetching from PWI
+		# themselves most of the time
+		if self.status_period > self.status_maxage:
+			print("STATUSPERIOD (" + str(self.status_period) + ") is longer than STATUSMAXAGE (" + \
+				      str(self.status_maxage) + "); polling every " + str(self.status_maxage) + " seconds instead")
+			self.status_period = self.status_maxage
+
 
                 today = datetime.datetime.utcnow()
                 if datetime.datetime.now().hour >= 10 and datetime.datetime.now().hour <= 16:
@@ -328,7 +462,7 @@ class CDK700:
 		url = url + urllib.urlencode(kwargs.items())
 		return url
 
-	def pwiRequest(self, **kwargs):
+	def pwiRequest(self, timeout=None, **kwargs):
 		"""
 		Issue a request to PWI using the keyword=value parameters
 		supplied to the function, and return the response received from
@@ -339,10 +473,15 @@ class CDK700:
 		will request a slew to J2000 coordinates 10:20:30, 20:30:40, and will
 		(under normal circumstances) return the status of the telescope as an
 		XML string.
+
+		Requests reuse keep-alive connections from self.pwi; timeout (seconds)
+		overrides the default (PWITIMEOUT) for this request.
 		"""
-		url = self.makeUrl(**kwargs)
-		try: ret = urllib.urlopen(url).read()
+		path = "/?" + urllib.urlencode(kwargs.items())
+		try: ret = self.pwi.get(path, timeout=timeout)
 		except: ret = False
+		# any command may change the state; don't serve a status fetched before it
+		if kwargs.get('cmd') != 'getsystem': self.last_command_time = time.time()
 #			self.restartPWI()
 #			ret = urllib.urlopen(url).read()
 		return ret
@@ -353,7 +492,7 @@ class CDK700:
 		the tree of tag names; e.g. "status.mount.ra"
 		"""
 
-		return elementTreeToObject(ElementTree.fromstring(xml))
+		return elementTreeToObjectFlat(ElementTree.fromstring(xml))
 
 
 	def pwiRequestAndParse(self, **kwargs):
@@ -382,11 +521,28 @@ class CDK700:
 
 		return status    
 
-	def getStatus(self):
+	def getStatus(self, maxage=None):
 		"""
 		Return a status object representing the tree structure of the XML text.
 		Example: getStatus().mount.tracking --> "False"
+
+		The status is shared between threads: if the cached status is younger
+		than maxage seconds (default STATUSMAXAGE) and no command has been sent
+		since it was requested, it is returned without asking PWI. Only one
+		thread fetches at a time; the others wait for and reuse its result.
+		Use maxage=0 to force a new request.
 		"""
+		if maxage == None: maxage = self.status_maxage
+
+		with self.status_lock:
+			if self.status_cache != None and self.status_time > self.last_command_time and \
+				    (time.time() - self.status_time) <= maxage:
+				return self.status_cache
+			return self.fetchStatus()
+
+	# request the status from PWI and update the cache
+	def fetchStatus(self):
+		t0 = time.time()
 		xmlstatus = self.getStatusXml()
 		if xmlstatus == False:
 			status = False
@@ -395,13 +551,16 @@ class CDK700:
 			xmlfile = open(self.base_directory + '/dependencies/telstateunknown.xml','r')
 			errxml = xmlfile.readline()
 			status = self.parseXml(errxml)
+		else:
+			self.status_cache = status
+			self.status_time = t0
 
 		self.logger.debug('Alt/Az RMS error: ' + status.mount.alt_rms_error_arcsec + ',' + status.mount.azm_rms_error_arcsec)
 		self.logger.debug('Alt/Az: ' + status.mount.alt_radian + ',' + status.mount.azm_radian)
 		return status
 
-	def getFocuserStatus(self,m3port):
-		telescopeStatus = self.getStatus()
+	def getFocuserStatus(self,m3port,telescopeStatus=None):
+		if telescopeStatus == None: telescopeStatus = self.getStatus()
 		if str(m3port) == '1': return telescopeStatus.focuser1
 		return telescopeStatus.focuser2
 
@@ -412,6 +571,23 @@ class CDK700:
 
 	def write_status(self):
 		pass
+
+	# refresh the shared status every status_period seconds (no longer than
+	# status_maxage, see load_config) so callers rarely have to wait on
+	# PWI; exits when the main thread stops
+	def statusPollerThread(self):
+
+		for i in threading.enumerate():
+				if i.name == "MainThread":
+					main_thread = i
+					break
+		while main_thread.is_alive():
+			t0 = time.time()
+			try:
+				with self.status_lock:
+					self.fetchStatus()
+			except: self.logger.exception('Error polling the telescope status')
+			time.sleep(max(self.status_period - (time.time() - t0),0.0))
 		
 	#status thread, exit when main thread stops
 	def write_status_thread(self):
@@ -477,15 +653,19 @@ class CDK700:
 		focuserStatus = self.getFocuserStatus(m3port)
 
 		t0 = datetime.datetime.utcnow()
-		elapsedTime = 0.0
-		
+
 		# wait for the focuser to finish moving
 		# or the timeout (90 seconds is about how long it takes to go from one extreme to the other)
-		while focuserStatus.moving == 'True' and elapsedTime < timeout:
-			self.logger.info('Focuser on port ' + str(m3port) + ' moving (' + str(focuserStatus.position) + ')')
-			time.sleep(1)
-			focuserStatus = self.getFocuserStatus(m3port)
-			elapsedTime = (datetime.datetime.utcnow()-t0).total_seconds()
+		try: expected = abs(float(focuserStatus.position) - float(position))/self.focuser_speed
+		except: expected = None
+		def stopped():
+			focuserStatus = self.getFocuserStatus(m3port,telescopeStatus=self.getStatus(maxage=self.wait_mininterval))
+			if focuserStatus.moving != 'True': return True
+			self.logger.debug('Focuser on port ' + str(m3port) + ' moving (' + str(focuserStatus.position) + ')')
+			return False
+		utils.wait_until(stopped, timeout, expected=expected, mininterval=self.wait_mininterval, maxinterval=1.0)
+		focuserStatus = self.getFocuserStatus(m3port)
+		elapsedTime = (datetime.datetime.utcnow()-t0).total_seconds()
 
 		if abs(float(focuserStatus.position) - float(position)) > 10:
 			self.logger.warning('Focuser on port ' + str(m3port) + ' (' + focuserStatus.position + ') not at requested position (' + str(position) + ') after ' + str(elapsedTime) + ' seconds')
@@ -693,14 +873,15 @@ class CDK700:
 		rotatorStatus = self.getRotatorStatus(m3port)
 
 		t0 = datetime.datetime.utcnow()
-		elapsedTime = 0
-		while rotatorStatus.finding_home == 'True' and elapsedTime < timeout:
-			elapsedTime = (datetime.datetime.utcnow() - t0).total_seconds()
-			self.logger.info('Homing rotator ' + str(m3port) + ' (elapsed time = ' + str(elapsedTime) + ')')
-			time.sleep(5.0)
-			rotatorStatus = self.getRotatorStatus(m3port)
+		def homed():
+			if self.getRotatorStatus(m3port,telescopeStatus=self.getStatus(maxage=self.wait_mininterval)).finding_home != 'True': return True
+			self.logger.debug('Homing rotator ' + str(m3port) + ' (elapsed time = ' + str((datetime.datetime.utcnow() - t0).total_seconds()) + ')')
+			return False
+		homed = utils.wait_until(homed, timeout, mininterval=self.wait_mininterval, maxinterval=5.0)
+		rotatorStatus = self.getRotatorStatus(m3port)
+		elapsedTime = (datetime.datetime.utcnow() - t0).total_seconds()
 
-		if elapsedTime > timeout:
+		if not homed:
 			self.logger.error('Homing rotator ' + str(m3port) + ' failed')
 			self.rotatorMoving = False
 			lock.release()
@@ -708,14 +889,9 @@ class CDK700:
 
 		self.logger.info('Homing rotator ' + str(m3port) + ' complete; moving to nominal position (elapsed time = ' + str(elapsedTime) + ')')
 
-		t0 = datetime.datetime.utcnow()
-		elapsedTime = 0
-		
-		while rotatorStatus.moving == 'True' and elapsedTime < 20.0:
-			elapsedTime = (datetime.datetime.utcnow() - t0).total_seconds()
-			self.logger.info('Moving rotator ' + str(m3port) + ' to nominal position (elapsed time = ' + str(elapsedTime) + ')')
-			time.sleep(1.0)
-			rotatorStatus = self.getRotatorStatus(m3port)
+		stopped = lambda: self.getRotatorStatus(m3port,telescopeStatus=self.getStatus(maxage=self.wait_mininterval)).moving != 'True'
+		utils.wait_until(stopped, 20.0, mininterval=self.wait_mininterval, maxinterval=1.0)
+		rotatorStatus = self.getRotatorStatus(m3port)
 			
 		if rotatorStatus.moving == 'True':
 			self.logger.error('Homing rotator ' + str(m3port) + ' failed')
@@ -1063,14 +1239,50 @@ class CDK700:
 
 	def addPointToModel():
 		pass
-	
+
+	# picks a random bright star (brighter than maxmag) within the
+	# requested alt/az region and returns its current ra, dec (J2000 +
+	# proper motion), or None if no star in the region qualifies
+	def pickPointingStar(self, minalt, maxalt, minaz, maxaz, maxmag, ntries=50):
+
+		for i in range(ntries):
+			# pick a random star from those roughly in the requested region now
+			with self.observer_lock:
+				self.observer.date = datetime.datetime.utcnow()
+				lst = math.degrees(self.observer.sidereal_time())/15.0
+			candidates = utils.brightStarsInRegion(lst, float(self.site.latitude), minalt=minalt-1.0, maxalt=maxalt+1.0,
+							       minaz=minaz, maxaz=maxaz, maxmag=maxmag)
+			if len(candidates) == 0:
+				self.logger.error("No stars brighter than " + str(maxmag) + " in the requested region")
+				return None
+			star = candidates[random.randint(0,len(candidates)-1)]
+
+			# apply proper motion to coordinates
+			raj2000 = float(star['ra'])
+			decj2000 = float(star['dec'])
+			pmra = float(star['pmra'])
+			pmdec = float(star['pmdec'])
+			ra,dec = self.starmotion(raj2000,decj2000,pmra,pmdec)
+			self.logger.info("J2000 " + str(raj2000) + ',' + str(decj2000) + 
+					 " adding proper motion " + str(pmra) + "," + str(pmdec) + 
+					 " is " + str(ra) + "," + str(dec))
+
+			# if the star is not in the region, try another one
+			alt,az = self.radectoaltaz(ra,dec)
+			if alt >= minalt and alt <= maxalt: return ra,dec
+
+		self.logger.error("Could not find a star in the requested region after " + str(ntries) + " tries")
+		return None
+
 	'''
 	makes a pointing model
+	with pipeline=True, the next star is chosen and the model is saved in
+	background threads while the telescope acquires the current star
 	'''
 	def makePointingModel(self, minerva, npoints=100, maxmag=4.0, 
 			      fau=True, brightstar=True, randomgrid=False, grid=False, 
 			      nalt=5, naz=20, exptime=1.0, filterName='V', shuffle=True, 
-			      minalt=-999, maxalt=80.0,minaz=0.0,maxaz=360.0):
+			      minalt=-999, maxalt=80.0,minaz=0.0,maxaz=360.0, pipeline=True):
 		
 		# can't set defaults using self...
 		if minalt == -999: minalt = self.horizon
@@ -1096,8 +1308,8 @@ class CDK700:
 			derotate = True
 
 		if brightstar:
-			brightstars = utils.brightStars(maxmag=maxmag)
-			nstars = len(brightstars['dec'])
+			# load the catalog up front (the region queries below reuse it)
+			utils.brightStarCatalog()
 		elif randomgrid:			
 			pass
 		elif grid:
@@ -1116,27 +1328,27 @@ class CDK700:
 			
 		pointsAdded = 0
 		ntried = 50
+		nextstar = None
+		saver = None
 		while pointsAdded < npoints:
 
 			ntried += 1
 
 			# create the pointing model by pointing to a series of bright stars
 			if brightstar:
-				ndx = random.random()*nstars
-
-				# apply proper motion to coordinates
-				raj2000 = float(brightstars['ra'][ndx])
-				decj2000 = float(brightstars['dec'][ndx])
-				pmra = float(brightstars['pmra'][ndx])
-				pmdec = float(brightstars['pmdec'][ndx])
-				ra,dec = self.starmotion(raj2000,decj2000,pmra,pmdec)
-				self.logger.info("J2000 " + str(raj2000) + ',' + str(decj2000) + 
-						 " adding proper motion " + str(pmra) + "," + str(pmdec) + 
-						 " is " + str(ra) + "," + str(dec))
-
-				# if the star is not above the horizon, skip to the next one
-				alt,az = self.radectoaltaz(ra,dec)
-				if alt < minalt or alt > maxalt: continue
+				if nextstar == None:
+					star = self.pickPointingStar(minalt,maxalt,minaz,maxaz,maxmag)
+				else:
+					nextstar.join()
+					star = nextstar.ret
+					nextstar = None
+				if star == None: break
+				ra,dec = star
+
+				# choose the next star while this one is acquired
+				if pipeline:
+					nextstar = PropagatingThread(target=self.pickPointingStar,args=(minalt,maxalt,minaz,maxaz,maxmag))
+					nextstar.start()
 			# create the pointing model by slewing to random alt/az coordinates
 			elif randomgrid:
 				alt = random.uniform(minalt,maxalt)
@@ -1144,7 +1356,7 @@ class CDK700:
 				# TODO: convert to ra/dec
 			# create the pointing model by slewing to to a grid of alt/az coordinates
 			elif grid:
-				if ntried > npoints: return
+				if ntried > npoints: break
 				alt = alts[shufflendx[ntried]]
 				az = azs[shufflendx[ntried]]
 				# TODO: convert to ra/dec
@@ -1169,11 +1381,13 @@ class CDK700:
 				self.logger.info("Adding point to model: ra = " + str(ra) + ", dec = " + str(dec))
 				self.mountAddToModel(ra,dec)
 				
-				# save to the model file
-				self.mountSaveModel(self.model[m3port])
+				# save to the model file (while slewing to the next star if pipelined)
+				if saver != None: saver.join()
+				saver = PropagatingThread(target=self.mountSaveModel,args=(self.model[m3port],))
+				saver.start()
+				if not pipeline: saver.join()
 
 				pointsAdded += 1
-				if pointsAdded >= npoints: return
 			continue
 		        #'''
 
@@ -1306,6 +1520,10 @@ class CDK700:
 		
 			pointsAdded += 1
 
+		# finish any background work before returning
+		if nextstar != None: nextstar.join()
+		if saver != None: saver.join()
+
 	# this is designed to calibrate the rotator using a single bright star
 	def calibrateRotator(self, camera, fau=True, exptime=1):
 
@@ -1408,9 +1626,9 @@ class CDK700:
 		#S If an allowable port is specified
 		if (str(m3port)=='1') or (str(m3port)=='2'):
 			self.logger.info('Ensuring m3 port is at port ' + str(m3port) )
-			while telescopeStatus.m3.port != str(m3port) and elapsedTime < timeout:
-				time.sleep(0.5)
-				#S This returns a status xml, so sending it on repeat shouldnt matter
+			if telescopeStatus.m3.port != str(m3port):
+				atport = lambda: self.getStatus(maxage=self.wait_mininterval).m3.port == str(m3port)
+				utils.wait_until(atport, timeout - elapsedTime, mininterval=self.wait_mininterval, maxinterval=0.5)
 				telescopeStatus = self.getStatus()
 				#S Need to track elapsed time.
 				elapsedTime = (datetime.datetime.utcnow() - start).total_seconds()
@@ -1471,9 +1689,13 @@ class CDK700:
 		focuserStatus = self.getFocuserStatus(m3port)
 		self.logger.info('Waiting for Focuser to finish slew; goto_complete = ' + focuserStatus.goto_complete)
 		timeout = 300.0
-		while focuserStatus.goto_complete == 'False' and elapsedTime < timeout:
-			time.sleep(0.5)
-			self.logger.debug('Focuser moving (' + str(focuserStatus.position) + ')')
+		if focuserStatus.goto_complete == 'False':
+			def focused():
+				focuserStatus = self.getFocuserStatus(m3port,telescopeStatus=self.getStatus(maxage=self.wait_mininterval))
+				if focuserStatus.goto_complete != 'False': return True
+				self.logger.debug('Focuser moving (' + str(focuserStatus.position) + ')')
+				return False
+			utils.wait_until(focused, timeout - elapsedTime, mininterval=self.wait_mininterval, maxinterval=0.5)
 			elapsedTime = (datetime.datetime.utcnow() - start).total_seconds()
 			focuserStatus = self.getFocuserStatus(m3port)
 
@@ -1517,9 +1739,13 @@ class CDK700:
 			self.rotatorStartDerotating(m3port)
 			timeout = 360.0
 			self.logger.info('Waiting for rotator to finish slew; goto_complete = ' + rotatorStatus.goto_complete)
-			while rotatorStatus.goto_complete == 'False' and elapsedTime < timeout:
-				time.sleep(0.5)
-				self.logger.debug('rotator moving (' + str(rotatorStatus.position) + ' degrees)')
+			if rotatorStatus.goto_complete == 'False':
+				def rotated():
+					rotatorStatus = self.getRotatorStatus(m3port,telescopeStatus=self.getStatus(maxage=self.wait_mininterval))
+					if rotatorStatus.goto_complete != 'False': return True
+					self.logger.debug('rotator moving (' + str(rotatorStatus.position) + ' degrees)')
+					return False
+				utils.wait_until(rotated, timeout - elapsedTime, mininterval=self.wait_mininterval, maxinterval=0.5)
 				elapsedTime = (datetime.datetime.utcnow() - start).total_seconds()
 				rotatorStatus = self.getRotatorStatus(m3port)
 
@@ -1541,78 +1767,77 @@ class CDK700:
 		self.nfailed = 0
 		return True
 
+	# apply proper motion, parallax and radial velocity to J2000 coordinates.
+	# ra (hours), dec (degrees), pmra/pmdec (mas/yr), px (mas), rv (m/s)
+	# and date may be scalars or arrays, which are broadcast against each
+	# other. Returns the corrected ra (hours), dec (degrees) as floats for
+	# scalar inputs or as arrays of the broadcast shape
 	def starmotion(self,ra,dec,pmra,pmdec,px=0.0,rv=0.0,date=None):
 
-		if date == None: date = datetime.datetime.utcnow()
-
-                ## Constants
-                #S Was using julian date of observation, but this was only to have a more general approach to
-                #S what coordinate system we were using. I assume we are using on J2000 coordinates, so I made it only take that for now.
-                #S It can be switched very easily though
-                #epoch = 2451545.0
-                j2000 = datetime.datetime(2000,01,01,12)
-                days_since_j2000 = (date-j2000).days #[] = daya
-                #jd_obs = days_since_j200 + jd_of_j2000
-                #S One AU in meters
-                AU  = 149597870700. #[] = meters
+		if date is None: date = datetime.datetime.utcnow()
+		scalar = all([np.ndim(x) == 0 for x in (ra,dec,pmra,pmdec,px,rv,date)])
+
+		## Constants
+		#S Was using julian date of observation, but this was only to have a more general approach to
+		#S what coordinate system we were using. I assume we are using on J2000 coordinates, so I made it only take that for now.
+		#S It can be switched very easily though
+		#epoch = 2451545.0
+		j2000 = datetime.datetime(2000,01,01,12)
+		if np.ndim(date) == 0: days_since_j2000 = (date-j2000).days #[] = days
+		else: days_since_j2000 = np.array([(d-j2000).days for d in np.ravel(date)]).reshape(np.shape(date))
+		#S One AU in meters
+		AU  = 149597870700. #[] = meters
 		days_in_year = 365.25
-                #S the seconds in a year
-                year_sec = days_in_year*24.*3600. #[] = seconds/year
-                #S Parsecs in an AU
-                pctoau = 3600.*180/math.pi #[] = AU
-                #S km/sec to AU/year
-                kmstoauy = year_sec*1000./AU
-
-                #S We are expecting RA to come in as decimal hours, so need to convert to degrees then radians
-                #S dec comes in as degrees.
-                rarad = np.radians(ra*15.0)
-		decrad = np.radians(dec)
-                #S basically see what values we can make corrections for.
-                        
-                #S Unit vector pointing to star's epoch location
-                r0hat = np.array([np.cos(rarad)*np.cos(decrad), np.sin(rarad)*np.cos(decrad), np.sin(decrad)])
-                #S Vector pointingup at celestial pole
-                up = np.array([0.,0.,1.])
-                #S Vector pointing east
-                east = np.cross(up, r0hat)
-                #S Normalize east vector
-                east = east/np.linalg.norm(east)
-                #S Unit vector pointing north
-                north =  np.cross(r0hat,east)
-                #S Proper motion correction (Not 100% sure what is going on with this calculation)
-		#S this is in AU/year??
-                mu = (pmra*east+pmdec*north)/pctoau/1000.
-
-                #S This can be used if we want to make our code more general and to be able to switch between epochs. I'm
-                #S assuming were sticking with j2000
-                ##epoch0 = 2000. + (epoch-2451545.0)/365.25
-                ##yearnow = 2000. + (jd_obs - 2451545.0)/365.25
-                #S Days since j2000
-                T = days_since_j2000/days_in_year
-                #S rv away from earth, with parallax
-                vpi = (rv/1000.)*kmstoauy*(px/1000./pctoau)
-                #S Total velocity of star on sky (proper motion plus rv away from earth)
-                vel = mu + vpi*r0hat
-                #S corrected vector from observer to object
-                r = vel*T + r0hat
-                #S Unit vector from observer to object
-                rhat = r/np.linalg.norm(r)
-
-                #S so we know rhat = [cos(dec)cos(ra),cos(dec)sin(ra),sin(dec)] for our corrected ra,dec
-                #S all we need to do is arcsin for declination, returns between [-pi/2,pi/2], converted to degrees
-                dec_corrected = np.degrees(np.arcsin(rhat[2]))
-                #S The tricky one is to get ra on [0,2pi], but this takes care of it. Converted to degrees in either case
-                #S arctan2 is rctan but chooses quadrant based on signs of arguements. Giving us ra on [-pi,pi]
-                ra_intermed  = np.arctan2(rhat[1],rhat[0])
-                #S Check to see if less than zero, add 2pi if so to make sure all angles are of ra on [0,2pi]
-                #S We do want to convert to decimal hours though
-
-                if ra_intermed < 0:
-                        ra_corrected = np.degrees(ra_intermed + 2*np.pi)/15.
-                else:
-                        ra_corrected = np.degrees(ra_intermed)/15.
-
+		#S the seconds in a year
+		year_sec = days_in_year*24.*3600. #[] = seconds/year
+		#S Parsecs in an AU
+		pctoau = 3600.*180/math.pi #[] = AU
+		#S km/sec to AU/year
+		kmstoauy = year_sec*1000./AU
+
+		#S We are expecting RA to come in as decimal hours, so need to convert to degrees then radians
+		#S dec comes in as degrees.
+		rarad = np.radians(np.asarray(ra,dtype=float)*15.0)
+		decrad = np.radians(np.asarray(dec,dtype=float))
+		cosra, sinra = np.cos(rarad), np.sin(rarad)
+		cosdec, sindec = np.cos(decrad), np.sin(decrad)
+
+		#S Unit vector pointing to star's epoch location
+		r0hat = (cosra*cosdec, sinra*cosdec, sindec)
+		#S Unit vector pointing east (up x r0hat, normalized)
+		east = (-sinra, cosra, 0.0)
+		#S Unit vector pointing north (r0hat x east)
+		north = (-sindec*cosra, -sindec*sinra, cosdec)
+
+		#S Days since j2000
+		T = days_since_j2000/days_in_year
+		#S rv away from earth, with parallax
+		pmra = np.asarray(pmra,dtype=float)
+		pmdec = np.asarray(pmdec,dtype=float)
+		vpi = (np.asarray(rv,dtype=float)/1000.)*kmstoauy*(np.asarray(px,dtype=float)/1000./pctoau)
+		#S Proper motion (in AU/year??) plus rv away from earth gives the total velocity of
+		#S the star on the sky; the corrected vector from observer to object is then
+		r = [(pmra*east[i]+pmdec*north[i])/pctoau/1000.*T + vpi*r0hat[i]*T + r0hat[i] for i in range(3)]
+		norm = np.sqrt(r[0]**2 + r[1]**2 + r[2]**2)
+
+		#S so we know rhat = [cos(dec)cos(ra),cos(dec)sin(ra),sin(dec)] for our corrected ra,dec
+		#S all we need to do is arcsin for declination, returns between [-pi/2,pi/2], converted to degrees
+		dec_corrected = np.degrees(np.arcsin(r[2]/norm))
+		#S arctan2 chooses the quadrant based on the signs of the arguments, giving ra on [-pi,pi];
+		#S wrap to [0,2pi] and convert to decimal hours
+		ra_corrected = np.degrees(np.mod(np.arctan2(r[1],r[0]),2*np.pi))/15.
+
+		if scalar: return float(ra_corrected),float(dec_corrected)
 		return ra_corrected,dec_corrected
+
+	# apply starmotion to a list of target dictionaries (keys 'ra', 'dec'
+	# and optionally 'pmra', 'pmdec', 'px', 'rv') in one vectorized call.
+	# Returns arrays of the corrected ra (hours), dec (degrees)
+	def starmotionTargets(self,targets,date=None):
+		column = lambda key, default: np.array([float(target.get(key,default)) for target in targets])
+		return self.starmotion(column('ra',np.nan),column('dec',np.nan),
+				       column('pmra',0.0),column('pmdec',0.0),
+				       px=column('px',0.0),rv=column('rv',0.0),date=date)
 		
 
 	#TODO Search #TODOACQUIRE in control.py for all(?) calls on this function to be edited
@@ -1718,34 +1943,50 @@ class CDK700:
 	# returns true when moving in RA/Dec
 	# NOTE: when not tracking, it's "moving"
 	def isMoving(self, timeout=15.0):
-		telescopeStatus = self.getStatus()
-		timeElapsed = 0.0
-		t0 = datetime.datetime.utcnow()
-		while telescopeStatus.mount.moving == 'True' and timeElapsed < timeout:
-			time.sleep(1.0)
-			timeElapsed = (datetime.datetime.utcnow() - t0).total_seconds()			
-			telescopeStatus = self.getStatus()
-			
-		return telescopeStatus.mount.moving == 'True'
+		stopped = lambda: self.getStatus(maxage=self.wait_mininterval).mount.moving != 'True'
+		return not utils.wait_until(stopped, timeout, mininterval=self.wait_mininterval, maxinterval=1.0)
 
+	# ra (hours), dec (degrees) and date (UTC datetime) may be scalars or
+	# arrays, which are broadcast against each other. Returns alt, az in
+	# degrees, as floats for scalar inputs or arrays of the broadcast shape
 	def radectoaltaz(self,ra,dec,date=None):
 
 		# if set as a default, it evaluates once when the function is initialized
 		# not every time the function is called
-		if date == None: date = datetime.datetime.utcnow()
+		if date is None: date = datetime.datetime.utcnow()
+
+		scalar = np.ndim(ra) == 0 and np.ndim(dec) == 0 and np.ndim(date) == 0
+
+		# numeric coordinates are converted to radians once; anything else
+		# (e.g., sexagesimal strings) is parsed by ephem element by element
+		try:
+			ra = np.radians(np.asarray(ra,dtype=float)*15.0)
+			dec = np.radians(np.asarray(dec,dtype=float))
+		except ValueError:
+			ra = np.vectorize(lambda x: float(ephem.hours(str(x))),otypes=[float])(ra)
+			dec = np.vectorize(lambda x: float(ephem.degrees(str(x))),otypes=[float])(dec)
+		ra, dec, date = np.broadcast_arrays(ra,dec,np.asarray(date,dtype=object))
+		alt = np.empty(ra.shape)
+		az = np.empty(ra.shape)
 
-		obs = ephem.Observer()
-		obs.lat = str(self.site.latitude)
-		obs.long = str(self.site.longitude)
-		obs.elevation = self.site.elevation
-		obs.date = str(date)
 		star = ephem.FixedBody()
-		star._ra = ephem.hours(str(ra))
-		star._dec = ephem.degrees(str(dec))
-		star.compute(obs)
-		alt = utils.ten(str(star.alt))
-		az = utils.ten(str(star.az))
-		self.logger.info("Alt/Az = " + str(alt) + "," + str(az) + " at RA/Dec = " + str(ra) + ',' + str(dec) + ", date = " + str(date) + ', lat=' + str(obs.lat) + ', lon = ' + str(obs.long))
+		with self.observer_lock:
+			obs = self.observer
+			lastdate = None
+			for i in np.ndindex(ra.shape):
+				if date[i] is not lastdate:
+					obs.date = str(date[i])
+					lastdate = date[i]
+				star._ra = ra[i]
+				star._dec = dec[i]
+				star.compute(obs)
+				alt[i] = math.degrees(star.alt)
+				az[i] = math.degrees(star.az)
+
+		if scalar:
+			self.logger.info("Alt/Az = " + str(alt[()]) + "," + str(az[()]) + " at RA/Dec = " + str(math.degrees(ra[()])/15.0) + ',' + str(math.degrees(dec[()])) + ", date = " + str(date[()]) + ', lat=' + str(obs.lat) + ', lon = ' + str(obs.long))
+			return alt[()],az[()]
+		self.logger.debug('Computed Alt/Az for ' + str(alt.size) + ' positions')
 		return alt,az
 
 	def m3port_switch(self,m3port, force=False):
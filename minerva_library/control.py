@@ -46,6 +46,7 @@ import Plot_fits
 import PID_test as pid
 from read_guider_output import get_centroid
 from propagatingthread import PropagatingThread
+import ringbuffer
 
 class control:
 	
@@ -75,6 +76,9 @@ class control:
 		#S See below, lots of new objects created here. 
 		self.create_class_objects()
 		self.logger_lock = threading.Lock()
+
+		# fiber offsets, keyed by file name -> (mtime, (xoffset,yoffset))
+		self.fiber_offsets = {}
 		
 	#create class objects needed to control Minerva system
 	def create_class_objects(self):
@@ -814,6 +818,31 @@ class control:
 
 		return filename
 
+	# arbitrary offset from the nominal fiber position (experimental),
+	# read from <telid>_fiber_offset.txt. The file is only re-read when its
+	# modification time changes so the guide loop doesn't parse it every
+	# iteration, but edits made during the night are still picked up
+	def getFiberOffset(self, telid):
+		offset_file = self.base_directory + '/' + telid + '_fiber_offset.txt'
+
+		try: mtime = os.stat(offset_file).st_mtime
+		except OSError:
+			if offset_file in self.fiber_offsets:
+				self.logger.info(telid + ": offset file removed, using nominal fiber position")
+				del self.fiber_offsets[offset_file]
+			return (0.0,0.0)
+
+		cached = self.fiber_offsets.get(offset_file)
+		if cached != None and cached[0] == mtime:
+			return cached[1]
+
+		with open(offset_file) as fh:
+			entries = fh.readline().split()
+			offset = (float(entries[0]),float(entries[1]))
+		self.logger.info(telid + ": offset file found, applying offset to fiber position (" + str(offset[0]) + "," + str(offset[1]) + ")")
+		self.fiber_offsets[offset_file] = (mtime,offset)
+		return offset
+
 	def fauguide(self,target,telid,guiding=True,xfiber=None, yfiber=None, acquireonly=False, skiponfail=False, artificial=False, ao=False, maxfail=5, simulate=False):
 
 		telescope = utils.getTelescope(self,telid)
@@ -851,10 +880,13 @@ class control:
 			      Correction_max = camera.fau.fCorr_max)
 		pfast.setPoint((camera.fau.xfiber, camera.fau.yfiber))
 
-		tvals=np.array([])
-		xvals=np.array([])
-		yvals=np.array([])
 		npts=10000
+		# preallocated guide history (the loop runs at most npts+1 times)
+		tvals=ringbuffer.RingBuffer(npts+1)
+		xvals=ringbuffer.RingBuffer(npts+1)
+		yvals=ringbuffer.RingBuffer(npts+1)
+		xfilter=camera.fau.filterstate()
+		yfilter=camera.fau.filterstate()
 		error = np.zeros((npts, 2))
 		curpos_old = np.array([-1.0, -1])
 		converged=False
@@ -913,16 +945,7 @@ class control:
 
 				if simulate: 
 					# include an arbitrary offset from the nominal position (experimental)
-					offset_file = self.base_directory + '/' + telid + '_fiber_offset.txt'
-				
-					if os.path.exists(offset_file):
-						with open(offset_file) as fh:
-							entries = fh.readline().split()
-							xoffset = float(entries[0])
-							yoffset = float(entries[1])
-							self.logger.info(telid + ": offset file found, applying offset to fiber position (" + str(xoffset) + "," + str(yoffset) + ")")
-							offset = (xoffset,yoffset)
-					else: offset = (0.0,0.0)		
+					offset = self.getFiberOffset(telid)
 
 					xstar = int(round(camera.fau.xfiber + offset[0] + np.random.uniform(low=-1.0,high=1.0)))
 					ystar = int(round(camera.fau.yfiber + offset[1] + np.random.uniform(low=-1.0,high=1.0)))
@@ -955,25 +978,15 @@ class control:
 				self.logger.info("Using the star at (x,y)=(" + str(xstar) + "," + str(ystar) +  "); last updated at " + str(guidetime))
 
 				# include an arbitrary offset from the nominal position (experimental)
-				offset_file = self.base_directory + '/' + telid + '_fiber_offset.txt'
-				
-				if os.path.exists(offset_file):
-					with open(offset_file) as fh:
-						entries = fh.readline().split()
-						xoffset = float(entries[0])
-						yoffset = float(entries[1])
-						self.logger.info(telid + ": offset file found, applying offset to fiber position (" + str(xoffset) + "," + str(yoffset) + ")")
-				else:
-					xoffset = 0.0
-					yoffset = 0.0
+				xoffset, yoffset = self.getFiberOffset(telid)
 
 				p.setPoint((camera.fau.xfiber+xoffset,camera.fau.yfiber+yoffset))
 				pfast.setPoint((camera.fau.xfiber+xoffset,camera.fau.yfiber+yoffset))
 
 				curpos = np.array([xstar,ystar])
-				tvals = np.append(tvals,i)
-				xvals = np.append(xvals, curpos[0])
-				yvals = np.append(yvals, curpos[1])
+				tvals.append(i)
+				xvals.append(curpos[0])
+				yvals.append(curpos[1])
 				
 				# make sure it's actually converging
 				if not camera.fau.acquired:
@@ -994,8 +1007,8 @@ class control:
 					# TODO:
 					# if we see this often, we probably want to automatically recalibrate the rotator!
 
-				filterx=camera.fau.filterdata(xvals, N=camera.fau.smoothing)
-				filtery=camera.fau.filterdata(yvals, N=camera.fau.smoothing)
+				filterx=xfilter.update(curpos[0])
+				filtery=yfilter.update(curpos[1])
 				filtercurpos=np.array([filterx, filtery])
 				separation = camera.fau.dist(camera.fau.xfiber+xoffset-curpos[0], camera.fau.yfiber+yoffset-curpos[1])*camera.fau.platescale
 				self.logger.info(telid + ": Target is at (" + str(curpos[0]) + ',' + str(curpos[1]) + "), " + str(separation) + '" away from the fiber (' + str(camera.fau.xfiber) + "," + str(camera.fau.yfiber) + ") -- tolerance is " + str(camera.fau.acquisition_tolerance) + '"')
@@ -1116,10 +1129,10 @@ class control:
 				self.logger.debug(telid + ": Updatevalue: " + str(updateval[0])+" "+str(updateval[1]))
 				self.logger.debug(telid + ": Commanding update: " + str(telupdateval[0])+" "+str(telupdateval[1]))
 				if i >50:
-					meanx = np.mean((xvals)[50:])
-					meany = np.mean((yvals)[50:])
-					stdx  = np.std( (xvals)[50:])
-					stdy  = np.std( (yvals)[50:])
+					meanx = xvals.mean(len(xvals)-50)
+					meany = yvals.mean(len(yvals)-50)
+					stdx  = xvals.std(len(xvals)-50)
+					stdy  = yvals.std(len(yvals)-50)
 
 					self.logger.debug(telid + ": Mean x position  " + str(meanx))
 					self.logger.debug(telid + ": Std x position  " + str(stdx))
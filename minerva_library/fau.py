@@ -16,6 +16,26 @@ import cdk700
 sys.dont_write_bytecode = True
 import numpy as np
 import utils
+import ringbuffer
+
+# streaming equivalent of fau.filterdata: keeps only the last N samples
+# and returns the same latest filtered value in O(N) per update
+class StreamingFilter:
+
+	def __init__(self, N=5):
+		self.N = int(N)
+		self.kernel = np.ones(self.N)/self.N
+		self.history = ringbuffer.RingBuffer(self.N)
+
+	def update(self, value):
+		self.history.append(value)
+		return self.value()
+
+	def value(self):
+		vals = self.history.window()
+		if vals.size < self.N:
+			return vals[-1]
+		return np.convolve(vals, self.kernel, 'valid')[-1]
 
 class fau:
 
@@ -38,6 +58,10 @@ class fau:
 		self.set_size()
 
 	def filterdata(self, vals, N=5):
+		# only the last N samples contribute to the last output sample, so
+		# don't convolve the whole history (vals may be a RingBuffer)
+		if isinstance(vals, ringbuffer.RingBuffer): vals = vals.window(N)
+		else: vals = np.asarray(vals)[-N:]
 		if vals.size < N:
         #S Returns the last element, but how is this equivalent to the else? Too few elements?
         #S No catch if vals.size > N? Need to figure what this is trying to do.
@@ -56,6 +80,12 @@ class fau:
 		return np.array([[np.cos(thetarad), -np.sin(thetarad)],
 				 [np.sin(thetarad), np.cos(thetarad)]])
 
+	# streaming filter state for the guide loop, equivalent to calling
+	# filterdata on the full history after each new sample
+	def filterstate(self, N=None):
+		if N == None: N = self.smoothing
+		return StreamingFilter(N)
+
 	def firstmove(self):
 		pass
 
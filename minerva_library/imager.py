@@ -19,6 +19,7 @@ sys.dont_write_bytecode = True
 import utils
 import utils2
 import numpy as np
+import zlib
 
 class imager:
 
@@ -26,6 +27,10 @@ class imager:
 
 		self.mailsent = False
 		self.lock = threading.Lock()
+		# each thread gets its own persistent connection to the server (see
+		# send_persistent), so a status query from one thread isn't stuck
+		# behind a long command (e.g., save_image) sent by another
+		self.server_local = threading.local()
 		self.config_file = config
 		self.base_directory = base
                 self.thach = thach
@@ -74,6 +79,12 @@ class imager:
 			self.flatminsunalt = float(config['Setup']['FLATMINSUNALT'])
 			self.flatmaxsunalt = float(config['Setup']['FLATMAXSUNALT'])
 			self.datadir = config['Setup']['DATADIR']
+			# serve many commands over one connection (falls back automatically)
+			try: self.persistent = config['Setup']['PERSISTENT'] == 'True'
+			except: self.persistent = not self.thach
+			# whether the server takes the header in one message; None until
+			# a persistent connection tells us (see supports_bulk_header)
+			self.bulk_header = None
 			self.gitpath = ''
 			self.file_name = 'test'
 			self.guider_file_name = ''
@@ -144,31 +155,136 @@ class imager:
 
 		self.nserver_failed = 0
 		return s
-	#send commands to camera server
-	def send(self,msg,timeout):
+	# open a persistent connection to the camera server for the calling
+	# thread, over which many newline-terminated commands are served. The
+	# server's answer lists any optional commands it supports. Returns
+	# False (and disables persistent connections) if the server only
+	# handles one command per connection
+	def connect_persistent(self):
+		s = self.connect_server()
+		if not s: return False
+
+		try:
+			s.settimeout(3)
+			s.sendall('persistent none\n')
+			data = s.recv(1024)
+		except:
+			self.logger.exception('Failed to open a persistent connection')
+			s.close()
+			return False
+
+		if len(data.split()) == 0 or data.split()[0] != 'success':
+			self.logger.info('Imager server does not support persistent connections; using one connection per command')
+			self.persistent = False
+			self.bulk_header = False
+			s.close()
+			return False
+
+		self.bulk_header = 'write_header_bulk' in data.split()[1:]
+		self.server_local.socket = s
+		self.server_local.buffer = ''
+		return True
+
+	# close the calling thread's persistent connection (connections of
+	# threads that have finished are closed when they're garbage collected)
+	def close_persistent(self):
+		if getattr(self.server_local,'socket',None) != None:
+			try: self.server_local.socket.close()
+			except: pass
+		self.server_local.socket = None
+		self.server_local.buffer = ''
+
+	# send a command over the calling thread's persistent connection and
+	# return the raw response. Returns None if the command never reached
+	# the server (the connection couldn't be opened, the send failed, or
+	# the server had already closed the idle connection), so it's safe to
+	# send it again, and False if the connection was lost after the
+	# command was sent (it may still be running on the server). Either way
+	# the connection is closed and reopened on the next command
+	def send_persistent(self,msg,timeout,payload=None):
+
+		local = self.server_local
+		if getattr(local,'socket',None) == None and not self.connect_persistent():
+			return None
+
+		s = local.socket
+		try:
+			self.logger.debug("Sending message: " + msg)
+			s.settimeout(3)
+			if payload == None: s.sendall(msg + '\n')
+			else: s.sendall(msg + '\n' + payload)
+		except:
+			self.logger.info("Persistent connection to the imager server lost")
+			self.close_persistent()
+			return None
+
+		received = False
+		try:
+			s.settimeout(timeout)
+			while '\n' not in local.buffer:
+				chunk = s.recv(4096)
+				if not chunk:
+					self.close_persistent()
+					if received: return False
+					self.logger.info("Persistent connection closed by the imager server")
+					return None
+				received = True
+				local.buffer += chunk
+		except socket.error as e:
+			self.close_persistent()
+			# a reset before any response means the server had closed the
+			# connection before the command arrived
+			if not received and e.errno == errno.ECONNRESET:
+				self.logger.info("Persistent connection reset by the imager server")
+				return None
+			return False
+		except:
+			self.close_persistent()
+			return False
+
+		data, local.buffer = local.buffer.split('\n',1)
+		return data
+
+	#send commands to camera server; payload is raw data sent after the
+	#command line (only used by write_header_bulk)
+	def send(self,msg,timeout,payload=None):
 
 		self.logger.debug("Beginning serial communications with the imager server")
-		if True:
+
+		# try the persistent connection first; fall back to one connection
+		# per command (with the usual recovery) if it couldn't be used
+		data = None
+		if self.persistent: data = self.send_persistent(msg,timeout,payload=payload)
+
+		# the command reached the server but the response didn't come back;
+		# don't send it again while it may still be running
+		if data == False:
+			self.logger.error("Connection timed out")
+			if self.recover_server(): return self.send(msg,timeout,payload=payload)
+			return 'fail'
+
+		if data == None:
 
 			try:
 				s = self.connect_server()
 			except:
 				self.logger.error("Connection lost")
-				if self.recover_server(): return self.send(msg,timeout)
+				if self.recover_server(): return self.send(msg,timeout,payload=payload)
 				return 'fail'
 			try:
 				s.settimeout(3)
 			except:
 				self.logger.error("Failed to set timeout")
-				if self.recover_server(): return self.send(msg,timeout)
+				if self.recover_server(): return self.send(msg,timeout,payload=payload)
 				return 'fail'
 
 			try:
 				self.logger.debug("Sending message: " + msg)
-				s.sendall(msg)
+				if payload == None: s.sendall(msg)
+				else: s.sendall(msg + '\n' + payload)
 			except:
 				self.logger.error("Failed to send message (" + msg + ")")
-				if self.recover_server(): return self.send(msg,timeout)
+				if self.recover_server(): return self.send(msg,timeout,payload=payload)
 				return 'fail'
 
 			try:
@@ -177,28 +293,28 @@ class imager:
 				data = s.recv(1024)
 			except:
 				self.logger.error("Connection timed out")
-				if self.recover_server(): return self.send(msg,timeout)
+				if self.recover_server(): return self.send(msg,timeout,payload=payload)
 				return 'fail'
 
-			try:
-				command = msg.split()[0]
-				self.logger.info("data returned: " + data)
-                                if not self.thach:
-                                        data = repr(data).strip("'")
-#				else:
-#					data = repr(data).strip('"')
-				data_ret = data.split()[0]
+		try:
+			command = msg.split()[0]
+			self.logger.info("data returned: " + data)
+                        if not self.thach:
+                                data = repr(data).strip("'")
+#			else:
+#				data = repr(data).strip('"')
+			data_ret = data.split()[0]
 
-			except:
-				self.logger.error("Error processing server response")
-				if self.recover_server(): return self.send(msg,timeout)
-				return 'fail'
+		except:
+			self.logger.error("Error processing server response")
+			if self.recover_server(): return self.send(msg,timeout,payload=payload)
+			return 'fail'
 
-			if data_ret == 'fail':
-				self.logger.error("Command failed("+command+')')
-				return 'fail'
+		if data_ret == 'fail':
+			self.logger.error("Command failed("+command+')')
+			return 'fail'
 
-			return data
+		return data
 
 	def cool(self):
 
@@ -460,6 +576,14 @@ class imager:
 		if self.send(cmd,30) == 'success': return True
 		else: return False
 
+	# True if the server accepts the whole header in one message
+	# (write_header_bulk). Servers that do say so when a persistent
+	# connection is opened; if it's not known yet, open one to find out
+	def supports_bulk_header(self):
+		if self.bulk_header == None and self.persistent and getattr(self.server_local,'socket',None) == None:
+			self.connect_persistent()
+		return self.bulk_header == True
+
 	#write fits header for self.file_name, header_info must be in json format
 	def write_header(self, header_info, guider=False):
 
@@ -469,6 +593,17 @@ class imager:
 		if self.file_name == '':
 			self.logger.error('Empty file name')
 			return False
+
+		# send the whole (compressed) header in one message if the server
+		# knows how to take it; otherwise send it in pieces
+		if self.supports_bulk_header():
+			payload = zlib.compress(header_info)
+			if self.send('write_header_bulk ' + str(len(payload)) + ' zlib' + hdrstr,10,payload=payload) == 'success':
+				return True
+			else:
+				self.logger.error('Failed to write header')
+				return False
+
 		i = 800
 		length = len(header_info)
 		while i < length:
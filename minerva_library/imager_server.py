@@ -1,10 +1,16 @@
+import sys
+# use the multithreaded COM apartment so the camera can be driven from
+# the server's worker threads (must be set before win32com is imported)
+sys.coinit_flags = 0
 from configobj import ConfigObj
 from scp import SCPClient
 from win32com.client import Dispatch
+import pythoncom
 from scipy import stats
 import numpy as np
-import os,sys,glob, socket, logging, datetime, ipdb, time, json, threading, pyfits, subprocess, collections
+import os,sys,glob, socket, errno, logging, datetime, ipdb, time, json, threading, pyfits, subprocess, collections
 import atexit, win32api
+import zlib
 import utils
 import math
 import ao
@@ -14,11 +20,21 @@ import zwo
 
 class server:
 
+	# commands that only read state. These are served as soon as they
+	# arrive, even while a camera-owning command (e.g., save_image) runs;
+	# everything else is serialized by camera_lock. Commands that read the
+	# last image (getMean, getMode, isSuperSaturated, get_guide_star) are
+	# not on the list, since save_image or exposeGuider may still be
+	# writing it
+	readonly_commands = ['get_status','get_temperature','get_index',
+			     'get_filter_name','isAOPresent']
+
 	def __init__(self, config, base=''):
 
 		self.config_file = config
 		self.base_directory = base
 		self.load_config()
+		self.camera_lock = threading.RLock()
 
                 if self.zwodirect: self.guider = zwo.zwo('',self.base_directory)
 
@@ -57,6 +73,9 @@ class server:
 			self.data_path_base = config['DATA_PATH']
 			self.logger_name = config['LOGNAME']
 			self.header_buffer = ''
+			# seconds a persistent client connection may sit idle before it's closed
+			try: self.persistent_timeout = float(config['PERSISTENT_TIMEOUT'])
+			except: self.persistent_timeout = 60.0
                         try: self.zwodirect = config['ZWODIRECT'] == 'True'
                         except: self.zwodirect = False
 		except:
@@ -90,7 +109,10 @@ class server:
                         status['Y2'] = self.cam.StartY + self.cam.NumY - 1
 		except:
                         self.logger.exception("error getting camera status")
-                        self.connect_camera()
+                        # get_status runs without camera_lock; don't reconnect
+                        # while another command is using the camera
+                        with self.camera_lock:
+                                self.connect_camera()
                         return self.get_status(param)
 
 		return 'success ' + json.dumps(status)
@@ -436,6 +458,22 @@ class server:
 			return 'fail'
 		return 'success'
 
+	# the whole header in one message: param is "<nbytes> <zlib|none> [guider]"
+	# and payload is the (optionally zlib-compressed) JSON header
+	def write_header_bulk(self,param,payload):
+
+		tokens = param.split()
+		try:
+			if tokens[1] == 'zlib': header_info = zlib.decompress(payload)
+			else: header_info = payload
+		except:
+			self.logger.exception('Error decoding header')
+			return 'fail'
+
+		if len(tokens) > 2 and tokens[2] == 'guider': header_info += ' guider'
+		self.header_buffer = ''
+		return self.write_header_done(header_info)
+
 	def set_data_path(self):
 		self.data_path = self.data_path_base + '\\' + self.night
 		if not os.path.exists(self.data_path):
@@ -553,7 +591,15 @@ class server:
 #used to process communication between camera client and server==#
 
 	#process received command from client program, and send response to given socket object
-	def process_command(self, command, conn):
+	# run a single command and return the response string
+	def execute_command(self, command):
+		tokens = command.split(None,1)
+		if len(tokens) > 0 and tokens[0] in self.readonly_commands:
+			return self.dispatch_command(command)
+		with self.camera_lock:
+			return self.dispatch_command(command)
+
+	def dispatch_command(self, command):
 		tokens = command.split(None,1)
 		if len(command) < 100:
 			self.logger.info('command received: ' + command)
@@ -624,6 +670,47 @@ class server:
 		else:
 			self.logger.info('command not recognized: (' + tokens[0] +')')
 			response = 'fail'
+
+		if response.split()[0] == 'fail':
+			self.logger.info('command failed (' + tokens[0] +')')
+		else:
+			self.logger.info('command succeeded (' + tokens[0] +')')
+		return response
+
+	# a command line followed by a binary payload (write_header_bulk)
+	def execute_bulk_command(self, line, payload):
+		tokens = line.split(None,1)
+		self.logger.info('command received: ' + tokens[0] + ' (' + str(len(payload)) + ' bytes)')
+		with self.camera_lock:
+			if tokens[0] == 'write_header_bulk':
+				response = self.write_header_bulk(tokens[1], payload)
+			else:
+				self.logger.info('command not recognized: (' + tokens[0] +')')
+				response = 'fail'
+
+		if response.split()[0] == 'fail':
+			self.logger.info('command failed (' + tokens[0] +')')
+		else:
+			self.logger.info('command succeeded (' + tokens[0] +')')
+		return response
+
+	# read the payload announced in a bulk command line ("<command> <nbytes> ...");
+	# buf holds bytes already received after the line. Returns the payload and
+	# any bytes received beyond it
+	def recv_payload(self, conn, line, buf):
+		nbytes = int(line.split()[1])
+		while len(buf) < nbytes:
+			data = conn.recv(max(nbytes - len(buf), 4096))
+			if not data: raise socket.error('connection closed while receiving payload')
+			buf += data
+		return buf[:nbytes], buf[nbytes:]
+
+	# one command per connection (the original protocol)
+	def process_command(self, command, conn):
+		response = self.execute_command(command)
+		self.respond(conn, response)
+
+	def respond(self, conn, response):
 		try:
 			conn.settimeout(3)
 			#self.logger.info('***'+response+'***')
@@ -631,14 +718,71 @@ class server:
 			conn.close()
 		except:
 			self.logger.exception('failed to send response, connection lost')
-			return
 
-		if response.split()[0] == 'fail':
-			self.logger.info('command failed (' + tokens[0] +')')
-		else:
-			self.logger.info('command succeeded (' + tokens[0] +')')
+	# serve newline-terminated commands over a single connection until the
+	# client closes it or it sits idle for persistent_timeout seconds.
+	# Each response is sent back terminated by a newline
+	def serve_persistent(self, conn):
+		self.logger.info('persistent connection opened')
+		buf = ''
+		try:
+			# tell the client which optional commands it can use
+			conn.settimeout(3)
+			conn.sendall('success write_header_bulk\n')
+			conn.settimeout(self.persistent_timeout)
+			while True:
+				while '\n' not in buf:
+					data = conn.recv(4096)
+					if not data:
+						self.logger.info('persistent connection closed by client')
+						return
+					buf += data
+				line, buf = buf.split('\n',1)
+				if line.startswith('write_header_bulk '):
+					payload, buf = self.recv_payload(conn, line, buf)
+					response = self.execute_bulk_command(line, payload)
+				else: response = self.execute_command(repr(line).strip("'"))
+				conn.settimeout(3)
+				conn.sendall(response + '\n')
+				conn.settimeout(self.persistent_timeout)
+		except socket.timeout:
+			self.logger.info('closing idle persistent connection')
+		except:
+			self.logger.exception('persistent connection lost')
+		finally:
+			conn.close()
 
-	#server loop that handles incoming command
+	# handle one client connection (in its own thread)
+	def handle_connection(self, conn):
+		pythoncom.CoInitializeEx(pythoncom.COINIT_MULTITHREADED)
+		try:
+			try:
+				conn.settimeout(3)
+				data = conn.recv(1024)
+			except:
+				self.logger.exception('failed to receive command')
+				conn.close()
+				return
+			if not data:
+				conn.close()
+				return
+			if data.startswith('persistent '):
+				self.serve_persistent(conn)
+			elif data.startswith('write_header_bulk '):
+				try:
+					line, sep, buf = data.partition('\n')
+					payload, buf = self.recv_payload(conn, line, buf)
+				except:
+					self.logger.exception('failed to receive header')
+					conn.close()
+					return
+				self.respond(conn, self.execute_bulk_command(line, payload))
+			else: self.process_command(repr(data).strip("'"),conn)
+		finally:
+			pythoncom.CoUninitialize()
+
+	#server loop that handles incoming command; each connection is served
+	#in its own thread so status queries aren't blocked by long commands
 	def run_server(self):
 
 		s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -649,18 +793,33 @@ class server:
 		#s.listen(True)
                 s.listen(4)
 
+		# accept() errors that mean the listening socket itself is gone
+		deadsocket = [errno.EBADF, errno.ENOTSOCK, errno.EINVAL,
+			      getattr(errno,'WSAENOTSOCK',None), getattr(errno,'WSAEINVAL',None)]
+
+		print 'listening to incoming connection on port ' + str(self.port)
+		nfailed = 0
 		while True:
-			print 'listening to incoming connection on port ' + str(self.port)
-			conn, addr = s.accept()
 			try:
-				conn.settimeout(3)
-				data = conn.recv(1024)
+				conn, addr = s.accept()
+			except socket.error as e:
+				if e.errno in deadsocket:
+					self.logger.exception('listening socket is closed')
+					raise
+				# back off so a persistent failure doesn't flood the log
+				self.logger.exception('failed to accept connection')
+				nfailed += 1
+				time.sleep(min(0.1*2**nfailed,10.0))
+				continue
 			except:
-				break
-			if not data:break
-			self.process_command(repr(data).strip("'"),conn)
-		s.close()
-		self.run_server()
+				self.logger.exception('failed to accept connection')
+				nfailed += 1
+				time.sleep(min(0.1*2**nfailed,10.0))
+				continue
+			nfailed = 0
+			thread = threading.Thread(target=self.handle_connection,args=(conn,))
+			thread.daemon = True
+			thread.start()
 
 if __name__ == '__main__':
     if socket.gethostname() == 'Minervared2-PC' or socket.gethostname() == 'Telcom-PC' or socket.gethostname() == 'minerva19-01':
@@ -0,0 +1,158 @@
+"""
+An SQLite-backed store for the observation history that the scheduler
+otherwise keeps as one tab-separated text file per target
+(schedule/rvobshistory/<name>.txt). Observations are appended to a single
+table indexed on (source, target, start), so history queries are index
+lookups instead of re-parsing every file with strptime.
+
+Several histories can share one database file: the source is the name of
+the directory the text files live in (e.g., rvobshistory and
+rvobshistoryred), and each store only sees its own source.
+
+To import the existing text files (the byte offset imported up to is kept
+per file, so only lines appended since the last import are read):
+    python obshistory.py <obspath> <dbfile>
+"""
+
+import sqlite3
+import threading
+import datetime
+import calendar
+import glob
+import os
+import sys
+
+# the source name of the history kept as text files in obspath
+def source_of(obspath):
+    return os.path.basename(os.path.normpath(obspath))
+
+class obshistory:
+    def __init__(self,dbfile,source):
+        self.dbfile = dbfile
+        self.source = source
+        # record_observation is called from the observing threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(dbfile, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS obs (source TEXT, target TEXT, start REAL, end REAL, '+\
+                                'duration REAL, alt REAL, az REAL, quality INTEGER)')
+            # an observation is only stored once, however it got here
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS obs_source_target_start ON obs (source, target, start)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS imported (filename TEXT PRIMARY KEY, nobs INTEGER, nbytes INTEGER)')
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # times are stored as (float) seconds since 1970 UTC
+    def to_epoch(self,date):
+        return calendar.timegm(date.timetuple()) + date.microsecond/1e6
+
+    def from_epoch(self,epoch):
+        return datetime.datetime.utcfromtimestamp(epoch)
+
+    def to_list(self,row):
+        # same layout as scheduler.get_obs_history:
+        # [start, end, duration, alt (deg), az (deg), quality]
+        return [self.from_epoch(row[0]),self.from_epoch(row[1]),row[2],row[3],row[4],float(row[5])]
+
+    def record(self,target,start,end,duration,alt,az,quality=1):
+        # whole seconds, like the text files, so importing a file that
+        # already has this observation doesn't add it again
+        start = start.replace(microsecond=0)
+        end = end.replace(microsecond=0)
+        with self.lock, self.db:
+            self.db.execute('INSERT OR IGNORE INTO obs VALUES (?,?,?,?,?,?,?,?)',
+                            (self.source,target,self.to_epoch(start),self.to_epoch(end),duration,alt,az,quality))
+
+    def history(self,target,start=None,end=None,goodonly=True):
+        # observations of target (in start order), optionally only those
+        # that started between start and end
+        query = 'SELECT start, end, duration, alt, az, quality FROM obs WHERE source=? AND target=?'
+        args = [self.source,target]
+        if start != None:
+            query += ' AND start>=?'
+            args.append(self.to_epoch(start))
+        if end != None:
+            query += ' AND start<=?'
+            args.append(self.to_epoch(end))
+        if goodonly: query += ' AND quality=1'
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY start',args).fetchall()
+        return [self.to_list(row) for row in rows]
+
+    def all_history(self,goodonly=True):
+        # the observations of every target, as a dictionary of lists
+        query = 'SELECT target, start, end, duration, alt, az, quality FROM obs WHERE source=?'
+        if goodonly: query += ' AND quality=1'
+        with self.lock:
+            rows = self.db.execute(query + ' ORDER BY target, start',(self.source,)).fetchall()
+        history = {}
+        for row in rows:
+            history.setdefault(row[0],[]).append(self.to_list(row[1:]))
+        return history
+
+    def last(self,target):
+        # the most recent good observation of target, or None
+        with self.lock:
+            row = self.db.execute('SELECT start, end, duration, alt, az, quality FROM obs '+\
+                                      'WHERE source=? AND target=? AND quality=1 ORDER BY start DESC LIMIT 1',
+                                  (self.source,target)).fetchone()
+        if row == None: return None
+        return self.to_list(row)
+
+    def count(self,target,start,end):
+        # number of good observations of target that started between start and end
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM obs WHERE source=? AND target=? AND start>=? AND start<=? AND quality=1',
+                                   (self.source,target,self.to_epoch(start),self.to_epoch(end))).fetchone()[0]
+
+    def import_text(self,obspath,dt_fmt='%Y%m%dT%H:%M:%S'):
+        # imports the lines of every <target>.txt history file in obspath
+        # (which should be this store's source) that haven't been imported
+        # yet, reading each file from where the last import stopped; returns
+        # the number of observations added
+        nadded = 0
+        for filename in sorted(glob.glob(os.path.join(obspath,'*.txt'))):
+            path = os.path.abspath(filename)
+            with self.lock:
+                done = self.db.execute('SELECT nobs, nbytes FROM imported WHERE filename=?',(path,)).fetchone()
+            if done == None: nobs, nbytes = 0, 0
+            else: nobs, nbytes = done
+
+            # a file that shrank was rewritten; read it again from the start
+            # (observations already stored are ignored)
+            size = os.path.getsize(filename)
+            if size < nbytes: nbytes = 0
+            if size == nbytes: continue
+
+            target = os.path.splitext(os.path.basename(filename))[0]
+            rows = []
+            with open(filename,'rb') as f:
+                f.seek(nbytes)
+                for line in f:
+                    # still being written; picked up by the next import
+                    if not line.endswith('\n'): break
+                    nbytes += len(line)
+                    line = line.split('\t')
+                    if len(line) < 6: continue
+                    start = datetime.datetime.strptime(line[0],dt_fmt)
+                    end = datetime.datetime.strptime(line[1],dt_fmt)
+                    rows.append((self.source,target,self.to_epoch(start),self.to_epoch(end),float(line[2]),
+                                 float(line[3]),float(line[4]),int(float(line[5]))))
+
+            with self.lock, self.db:
+                before = self.db.total_changes
+                self.db.executemany('INSERT OR IGNORE INTO obs VALUES (?,?,?,?,?,?,?,?)',rows)
+                nrows = self.db.total_changes - before
+                self.db.execute('INSERT OR REPLACE INTO imported VALUES (?,?,?)',(path,nobs+nrows,nbytes))
+            nadded += nrows
+        return nadded
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print 'usage: python obshistory.py <obspath> <dbfile>'
+        sys.exit()
+    store = obshistory(sys.argv[2],source_of(sys.argv[1]))
+    print 'Imported ' + str(store.import_text(sys.argv[1])) + ' observations into ' + sys.argv[2]
+    store.close()
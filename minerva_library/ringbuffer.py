@@ -0,0 +1,80 @@
+import numpy as np
+
+# fixed-capacity history of measurements (e.g., guide star positions).
+# appends are O(1) and never reallocate; once full, the oldest samples
+# are overwritten. Running sums are kept alongside the data so that the
+# mean and standard deviation of the most recent n samples are O(1).
+class RingBuffer:
+
+    def __init__(self, capacity, dtype=float):
+        self.capacity = int(capacity)
+        self.data = np.zeros(self.capacity, dtype=dtype)
+        self.count = 0
+        self.total = 0
+
+        # cumulative sums of (value - ref), indexed by the number of
+        # samples appended so far, modulo capacity+1. The reference
+        # (first sample) avoids cancellation in the variance
+        self.ref = 0.0
+        self.csum = np.zeros(self.capacity+1)
+        self.csumsq = np.zeros(self.capacity+1)
+
+    def __len__(self):
+        return self.count
+
+    # integer indexing with the same semantics as a numpy array of the
+    # retained samples (0 is the oldest, -1 the most recent)
+    def __getitem__(self, i):
+        if i < 0: i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError('RingBuffer index out of range')
+        return self.data[(self.total - self.count + i) % self.capacity]
+
+    def append(self, value):
+        if self.total == 0: self.ref = float(value)
+        self.data[self.total % self.capacity] = value
+
+        delta = float(value) - self.ref
+        prev = self.total % (self.capacity+1)
+        self.total += 1
+        cur = self.total % (self.capacity+1)
+        self.csum[cur] = self.csum[prev] + delta
+        self.csumsq[cur] = self.csumsq[prev] + delta*delta
+        self.count = min(self.count+1, self.capacity)
+
+    def clear(self):
+        self.count = 0
+        self.total = 0
+        self.ref = 0.0
+        self.csum[0] = 0.0
+        self.csumsq[0] = 0.0
+
+    # the last n samples (all retained samples if n is None) in
+    # chronological order. This is a view unless the window wraps
+    def window(self, n=None):
+        if n is None or n > self.count: n = self.count
+        if n <= 0: return self.data[0:0]
+        start = (self.total - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.data[start:start+n]
+        stop = self.total % self.capacity
+        return np.concatenate((self.data[start:], self.data[:stop]))
+
+    def _sums(self, n):
+        if n is None or n > self.count: n = self.count
+        cur = self.total % (self.capacity+1)
+        old = (self.total - n) % (self.capacity+1)
+        return n, self.csum[cur]-self.csum[old], self.csumsq[cur]-self.csumsq[old]
+
+    # mean of the last n samples (all retained samples if n is None)
+    def mean(self, n=None):
+        n, s, ss = self._sums(n)
+        if n <= 0: return np.nan
+        return self.ref + s/n
+
+    # population standard deviation (as np.std) of the last n samples
+    def std(self, n=None):
+        n, s, ss = self._sums(n)
+        if n <= 0: return np.nan
+        var = ss/n - (s/n)**2
+        return np.sqrt(max(var,0.0))
@@ -23,6 +23,7 @@ import subprocess
 import targetlist
 from configobj import ConfigObj
 import utils, env
+import obshistory
 
 ###
 # SCHEDULER
@@ -58,11 +59,31 @@ class scheduler:
         if self.red: self.bstarobserved=True
         else: self.bstarobserved = False
         
-        # get the target list
+        # observation history of every target, read once from obspath
+        # (see load_obs_history)
+        self.obs_history = {}
+        self.obs_history_path = None
+
+        # the database holds the history of every scheduler that shares it,
+        # each under its own source (the obspath directory). Lines added to
+        # the text files since the last import are imported on every start
+        if self.obshistorydb != None:
+            self.obsdb = obshistory.obshistory(os.path.join(self.base_directory,self.obshistorydb),
+                                               obshistory.source_of(self.obspath))
+            self.obsdb.import_text(self.obspath,dt_fmt=self.dt_fmt)
+        else: self.obsdb = None
+
+        # (previous sunrise, sunset, sunrise) of the night the targets'
+        # rise and set times were computed for (see calc_observability)
+        self.observability_night = None
+
+        # ephem bodies of the targets, reused when the list is reloaded
+        # (see make_fixedBodies)
+        self.fixedbodies = {}
+
+        # get the target list (and make the fixed bodies)
         self.update_list()
 
-        self.make_fixedBodies()
-
     def load_config(self):
         try:
 #            ipdb.set_trace()
@@ -73,6 +94,9 @@ class scheduler:
             self.target_max_horizon = float(config['Setup']['MAXALT'])
             self.targets_file = config['Setup']['TARGETSFILE']
             self.min_moon_sep = float(config['Setup']['MINMOONSEP'])
+            # optional SQLite observation history (see obshistory.py), relative to base_directory
+            try: self.obshistorydb = config['Setup']['OBSHISTORYDB']
+            except: self.obshistorydb = None
             # used for minerva logging
 #            self.logger_name = config['Setup']['LOGNAME']
 
@@ -89,26 +113,44 @@ class scheduler:
             print 'Something went wrong when sorting with ' + key
             return False
 
+    def top_targets(self,k=1,key='weight',weights=None):
+        #S returns the k targets with the highest key, best first, without
+        #S sorting the whole list. ties are broken by position in target_list,
+        #S as the (stable) sort in sort_target_list does. weights can be the
+        #S array of keys already computed (e.g., by calculate_weights)
+        if weights is None: weights = np.array([target[key] for target in self.target_list],dtype=float)
+        k = min(k,len(weights))
+        if k <= 0: return []
+
+        #S the kth highest weight; everything above it is in, and the
+        #S first of those equal to it fill the remaining places
+        threshold = -np.partition(-weights,k-1)[k-1]
+        above = np.flatnonzero(weights > threshold)
+        equal = np.flatnonzero(weights == threshold)[:k-len(above)]
+        ndx = np.concatenate((above,equal))
+        ndx = ndx[np.lexsort((ndx,-weights[ndx]))]
+        return [self.target_list[i] for i in ndx]
+
     def choose_target(self,key='weight',remaining_time=86400.0, logger=None, timeof=None, cadence=True):
         #S we assume you need to update the weights of targets
         #S this calculates weghts for those targets which are currently 
         #S observable, using datetime.datetime.utcnow()
-        self.calculate_weights(remaining_time=remaining_time, logger=logger, timeof=timeof, cadence=cadence)
+        weights = self.calculate_weights(remaining_time=remaining_time, logger=logger, timeof=timeof, cadence=cadence)
+        if key != 'weight': weights = None
 
-        #S next we sort the target list based on the weight key
-        self.sort_target_list(key=key)
-        #S now the highest weighted target is the first position of this list,
-        #S so we will just return the first entries dictionary
+        #S next we find the highest weighted target (no need to sort the
+        #S whole list for that) and return its dictionary
+        best = self.top_targets(k=1,key=key,weights=weights)
 
         # if no targets are observable, return an empty dictionary
-        if self.target_list[0]['weight'] == -999.0: 
+        if len(best) == 0 or best[0]['weight'] == -999.0: 
             if logger != None:
                 logger.info("No viable targets at " + str(timeof))
             else: 
                 print "No viable targets at " + str(timeof)
             return {}
  
-        return self.target_list[0]
+        return best[0]
 
 
     def update_list(self,bstar=False,includeInactive=False):
@@ -118,23 +160,43 @@ class scheduler:
         except:
             #S Placeholder for logger
             pass
+
+        # outside the try, so bad coordinates aren't silently skipped
+        self.make_fixedBodies()
         
-    def calculate_weights(self, tels=None, remaining_time=86400.0, logger=None, timeof=None, cadence=True):
+    def calculate_weights(self, tels=None, remaining_time=86400.0, logger=None, timeof=None, cadence=True, vectorized=True):
         #S need to update weights for all the targets in the list.
         #S going to use simple HA weighting for now.
         if timeof == None: timeof = datetime.datetime.utcnow()
 
+        # rise and set times only change from night to night
+        night = self.observability_night
+        if night == None or timeof <= night[0] or timeof > night[2]:
+            self.calc_observability(timeof=timeof,logger=logger)
+
+        # the same weights for all targets at once (see calculate_weights_vectorized)
+        if vectorized and self.observability_night != None and len(self.target_list) > 0:
+            return self.calculate_weights_vectorized(logger=logger, timeof=timeof, cadence=cadence)
+
         for target in self.target_list:
 
             # overwrite previous windows
             target['starttime'] = datetime.datetime(2015,01,01,00,00,00)
             target['endtime'] = datetime.datetime(2115,01,01,00,00,00)
 
-            try:
-                target = utils.truncate_observable_window(self.site, target,timeof=timeof,logger=logger)
-            except:
-                print 'lskdjf'
-                ipdb.set_trace()
+            if self.observability_night != None:
+                sunset, sunrise = self.observability_night[1:]
+                # targets added since the table was computed
+                if 'risetime' not in target.keys():
+                    target['risetime'], target['settime'] = utils.rise_set_times(self.site,target,sunset,sunrise,timeof=timeof)
+                target['starttime'] = max(target['starttime'],target['risetime'],sunset)
+                target['endtime'] = min(target['endtime'],sunrise,target['settime'])
+            else:
+                try:
+                    target = utils.truncate_observable_window(self.site, target,timeof=timeof,logger=logger)
+                except:
+                    print 'lskdjf'
+                    ipdb.set_trace()
 
             # if the target is observable
             if (target['starttime'] <= timeof) and (target['endtime'] >= (timeof + datetime.timedelta(seconds=target['exptime'][0]))):
@@ -166,13 +228,169 @@ class scheduler:
 
         #pass
 
+    def make_target_table(self):
+        """
+        Returns a columnar copy (numpy structured array, one row per entry
+        in target_list) of the target properties the weights depend on
+        that don't change during the night. Times are seconds since 1970.
+        It is rebuilt when the target list is replaced (e.g., by
+        update_list or sort_target_list) or changes length, or when the
+        night changes.
+        """
+        tablekey = (len(self.target_list), self.observability_night)
+        if getattr(self,'target_table_list',None) is self.target_list and self.target_table_key == tablekey:
+            return self.target_table
+
+        sunset, sunrise = self.observability_night[1:]
+        epoch = datetime.datetime(1970,1,1)
+        table = np.zeros(len(self.target_list), dtype=[('ra',float),('dec',float),('priority',float),
+                                                         ('seplimit',float),('maxobs',float),('exptime',float),
+                                                         ('bstar',bool),('risetime',float),('settime',float)])
+        for i,target in enumerate(self.target_list):
+            # targets added since the rise and set times were computed
+            if 'risetime' not in target.keys():
+                target['risetime'], target['settime'] = utils.rise_set_times(self.site,target,sunset,sunrise)
+            table[i] = (float(target['ra']), float(target['dec']), target['priority'],
+                        target.get('seplimit',np.nan), target.get('maxobs',np.nan), target['exptime'][0],
+                        target['bstar'], (target['risetime']-epoch).total_seconds(), (target['settime']-epoch).total_seconds())
+
+        # keep the list itself (not its id, which can be reused once the
+        # list is freed) to tell when it's been replaced
+        self.target_table = table
+        self.target_table_list = self.target_list
+        self.target_table_key = tablekey
+        return table
+
+    def calculate_weights_vectorized(self, logger=None, timeof=None, cadence=True):
+        """
+        Computes the same weights (and observing windows) as the loop in
+        calculate_weights, calc_weight_multi and calc_weight_ha, but as
+        array operations on the target table. Requires the rise and set
+        times for tonight (calc_observability).
+        """
+        if timeof == None: timeof = datetime.datetime.utcnow()
+
+        table = self.make_target_table()
+        sunset, sunrise = self.observability_night[1:]
+        epoch = datetime.datetime(1970,1,1)
+        now = (timeof-epoch).total_seconds()
+
+        # the window is limited by the target's rise and set and the sun
+        start = np.maximum(table['risetime'],(sunset-epoch).total_seconds())
+        end = np.minimum(table['settime'],(sunrise-epoch).total_seconds())
+        observable = (start <= now) & (end >= now + table['exptime'])
+
+        self.obs.date = timeof
+        lst = math.degrees(self.obs.sidereal_time())/15.0
+        priority = table['priority']
+
+        if cadence:
+            # time since the last observation of each observable target
+            since = np.zeros(len(table))
+            for i in np.flatnonzero(observable):
+                target = self.target_list[i]
+                target['last_obs'] = self.get_obs_history(target, timeof=timeof)
+                since[i] = (timeof-target['last_obs'][-1][0]).total_seconds()
+            observed = np.array([target.get('observed',0) for target in self.target_list],dtype=float)
+            seplimit = table['seplimit']
+            start_ha = -seplimit/3600.
+
+            # make sure it's been observed more than 'seplimit' apart and
+            # hasn't been observed more than maxobs times
+            history_weight = np.where(since < seplimit, -2.0, 0.0)
+            history_weight = np.where(observed > table['maxobs'], -99.0, history_weight)
+
+            #NM keep hour angle in range -12 to +12
+            target_ha = lst - table['ra']
+            target_ha = np.where(target_ha > 12, target_ha-24., target_ha)
+
+            # if hasn't been observed in the past day, boost its priority
+            cad_weight = np.where(since > 86400.0, 1.0, 0.0)
+
+            # first, second and third observations of a three obs run (see calc_weight_multi)
+            with np.errstate(divide='ignore',invalid='ignore'):
+                threeobs_weight = np.select([observed%3 == 0, observed%3 == 1],
+                                            [np.exp(-((target_ha-start_ha)**2./(2.*.5**2.)))\
+                                                 +1.5*np.exp(-(target_ha**2./(2.*1.0**2.))),
+                                             1+np.exp(-((target_ha+start_ha)**2./(2.*.75**2.)))\
+                                                 +1.5*np.exp(-(target_ha**2./(2.*2.5**2.)))],
+                                            2.+(since-seplimit)/seplimit)
+            weight = (threeobs_weight+cad_weight+history_weight)*priority
+            if observable.any(): self.start_ha = start_ha[np.flatnonzero(observable)[-1]]
+        else:
+            observed = np.array([target.get('observed',0) for target in self.target_list],dtype=float)
+            weight = (1.0 - np.abs((lst-table['ra'])/12.0))*priority
+            weight = np.where(observed > 2, -1.0, weight)
+
+        # weight for 1 Bstar per night
+        bstar = table['bstar'] & observable
+        if bstar.any():
+            if (self.bstarobserved):
+                # Only observe one B star per night (unless we have nothing better to do)
+                weight = np.where(bstar, weight/1000000.0, weight)
+            else:
+                # exponentially increase the priority of B stars as the night progresses
+                # multiply by 1 for 10 hours left in the night and 100 for 0.5 hours left in the night
+                timeleft = (self.nextsunrise(datetime.datetime.utcnow()) - datetime.datetime.utcnow()).total_seconds()
+                weight = np.where(bstar, weight*0.784*math.exp(8725.59/timeleft), weight)
+
+        # not observable
+        weight = np.where(observable, weight, -999.0)
+
+        for i,target in enumerate(self.target_list):
+            target['starttime'] = max(datetime.datetime(2015,01,01,00,00,00),target['risetime'],sunset)
+            target['endtime'] = min(datetime.datetime(2115,01,01,00,00,00),sunrise,target['settime'])
+            target['weight'] = float(weight[i])
+
+        if logger != None:
+            logger.debug(str(observable.sum()) + ' of ' + str(len(table)) + ' targets observable at ' + str(timeof))
+        self.weights = weight
+        return weight
+
+    def calc_observability(self,timeof=None,logger=None):
+        """
+        Computes the rise and set times (target['risetime'] and
+        target['settime']) of every target for the night containing timeof
+        (the next night during the day), which calculate_weights uses
+        instead of recomputing them for every target on every call.
+        """
+        if timeof == None: timeof = datetime.datetime.utcnow()
+
+        night = utils.observable_night(self.site,timeof=timeof,logger=logger)
+        if night == None:
+            self.observability_night = None
+            return False
+        sunset, sunrise = night
+
+        for target in self.target_list:
+            target['risetime'], target['settime'] = utils.rise_set_times(self.site,target,sunset,sunrise,timeof=timeof)
+
+        # the table is valid until sunrise, back to the previous sunrise
+        horizon = self.obs.horizon
+        self.observability_night = (self.prevsunrise(sunrise - datetime.timedelta(hours=1)),sunset,sunrise)
+        self.obs.horizon = horizon
+        return True
+
     def make_fixedBodies(self):
+        #S bodies are cached by name (and checked against the coordinates),
+        #S so reloading the list only recomputes the positions of targets
+        #S that haven't changed
+        fixedbodies = {}
         for target in self.target_list:
-            target['fixedbody'] = ephem.FixedBody()
-            target['fixedbody']._ra = ephem.hours(target['ra'])
-            target['fixedbody']._dec = ephem.degrees(target['dec'])
-#            target['fixedbody']._epoch = 2000.0
-            target['fixedbody'].compute(self.obs)
+            name, ra, dec = target['name'], target['ra'], target['dec']
+            cached = self.fixedbodies.get(name)
+            if cached != None and cached[0] == ra and cached[1] == dec: body = cached[2]
+            else:
+                body = ephem.FixedBody()
+                body._ra = ephem.hours(ra)
+                body._dec = ephem.degrees(dec)
+#                body._epoch = 2000.0
+                cached = (ra, dec, body)
+            fixedbodies[name] = cached
+            target['fixedbody'] = body
+            body.compute(self.obs)
+        # forget targets that are no longer in the list
+        self.fixedbodies = fixedbodies
         
     def calc_weight_ha(self,target,logger=None,timeof=None):
         """
@@ -272,6 +490,9 @@ class scheduler:
         # and might be useless to you.
         self.start_ha = np.random.normal(loc=-2.,scale=.5)
 
+        # read the observation history of all targets once
+        self.load_obs_history()
+
         for target in self.target_list:
             # reset targets observation counter for the night to zero
             target['observed']=0
@@ -295,7 +516,72 @@ class scheduler:
                     target['last_obs']=[[datetime.datetime(2000,1,1,0,0,0),datetime.datetime(2000,1,1,0,0,59),59,80,0,1]]
         # reset to sun horizon
         self.obs.horizon = str(self.sun_horizon)
+
+        # rise and set times of all targets for tonight
+        self.calc_observability(timeof=timeof)
                 
+    def read_obs_file(self,target_file):
+        # parses an observation history file into a list of
+        # [start, end, duration, alt, az, quality], keeping good observations
+        obs_list = []
+        with open(target_file) as f:
+            for line in f:
+                line = line.split('\t')
+                line[0] = datetime.datetime.strptime(line[0],self.dt_fmt) # start time of exposure
+                line[1] = datetime.datetime.strptime(line[1],self.dt_fmt) # end time of exposure
+                line[2] = float(line[2]) # duration in seconds of exposure
+                line[3] = float(line[3]) # altitude (degrees)
+                line[4] = float(line[4]) # azimuth (degrees)
+                line[5] = float(line[5]) # quality flag
+                # only count it if the observation is good
+                if line[5] == 1:
+                    obs_list.append(line)
+#                    if line[0] > self.prevsunset(timeof): target['observed'] += 1
+        return obs_list
+
+    def night_of(self,timeof):
+        # the night an observation belongs to, as the local (mean solar)
+        # date of the evening it started
+        return (timeof + datetime.timedelta(hours=float(self.site.longitude)/15.0 - 12.0)).date()
+
+    def index_obs_history(self,obs_list):
+        # the in-memory index entry for one target: the observations, their
+        # start times (seconds since 1970, sorted) and the number per night
+        epoch = datetime.datetime(1970,1,1)
+        obs_list = sorted(obs_list, key=lambda x:x[0])
+        offset = datetime.timedelta(hours=float(self.site.longitude)/15.0 - 12.0)
+        nights = {}
+        for obs in obs_list:
+            night = (obs[0] + offset).date() # see night_of
+            nights[night] = nights.get(night,0) + 1
+        return {'obs':obs_list,
+                'epochs':np.array([(obs[0]-epoch).total_seconds() for obs in obs_list]),
+                'nights':nights}
+
+    def load_obs_history(self,obspath=None):
+        """
+        Reads the observation history of every target into self.obs_history
+        so scheduling passes don't re-read the files; record_observation
+        keeps it up to date.
+        """
+        if obspath == None: obspath = self.obspath
+
+        self.obs_history = {}
+        self.obs_history_path = obspath
+
+        # one query for the whole history if it's in the database
+        if self.obsdb != None and obspath == self.obspath:
+            history = self.obsdb.all_history()
+            for target in self.target_list:
+                if target['name'] in history.keys():
+                    self.obs_history[target['name']] = self.index_obs_history(history[target['name']])
+            return
+
+        for target in self.target_list:
+            target_file = obspath+target['name']+'.txt'
+            if os.path.exists(target_file):
+                self.obs_history[target['name']] = self.index_obs_history(self.read_obs_file(target_file))
+
     def get_obs_history(self,target,obspath=None,timeof=None):
         if obspath == None:
             obspath = self.obspath
@@ -303,26 +589,29 @@ class scheduler:
         if timeof == None:
             timeof = datetime.datetime.utcnow()
 
+        # use the in-memory history if it was loaded from this path
+        if self.obs_history_path == None and obspath == self.obspath:
+            self.load_obs_history()
+        if obspath == self.obs_history_path:
+            if target['name'] in self.obs_history.keys():
+                return self.obs_history[target['name']]['obs']
+
         # a function that 'tail's a target file to get the last prev_obs and
         # places the details in a list?
         # add a line for the empty one at the end of a file?
 
         target_file = obspath+target['name']+'.txt'
-        if os.path.exists(target_file):
-            obs_list = []
-            with open(target_file) as f:
-                for line in f:
-                    line = line.split('\t')
-                    line[0] = datetime.datetime.strptime(line[0],self.dt_fmt) # start time of exposure
-                    line[1] = datetime.datetime.strptime(line[1],self.dt_fmt) # end time of exposure
-                    line[2] = float(line[2]) # duration in seconds of exposure
-                    line[3] = float(line[3]) # altitude (degrees)
-                    line[4] = float(line[4]) # azimuth (degrees)
-                    line[5] = float(line[5]) # quality flag
-                    # only count it if the observation is good
-                    if line[5] == 1:
-                        obs_list.append(line)
-#                        if line[0] > self.prevsunset(timeof): target['observed'] += 1
+        if self.obsdb != None and obspath == self.obspath:
+            obs_list = self.obsdb.history(target['name'])
+            if len(obs_list) == 0: obs_list = None
+        elif os.path.exists(target_file):
+            obs_list = self.read_obs_file(target_file)
+        else: obs_list = None
+
+        if obs_list != None:
+            if obspath == self.obs_history_path:
+                self.obs_history[target['name']] = self.index_obs_history(obs_list)
+                obs_list = self.obs_history[target['name']]['obs']
         else:
             # default to observed a long time ago
             obs_list = [[datetime.datetime(2000,1,1,0,0,0),datetime.datetime(2000,1,1,0,0,59),59,80,0,1]]
@@ -330,6 +619,22 @@ class scheduler:
 
         return obs_list
 
+    def count_observations(self,target,start,end=None):
+        # number of (good) observations of target that started between start
+        # and end, from the in-memory history
+        if end == None: end = datetime.datetime.utcnow()
+        if target['name'] not in self.obs_history.keys(): return 0
+        epoch = datetime.datetime(1970,1,1)
+        epochs = self.obs_history[target['name']]['epochs']
+        first, last = np.searchsorted(epochs,[(start-epoch).total_seconds(),(end-epoch).total_seconds()],side='right')
+        return last - first
+
+    def observations_in_night(self,target,timeof=None):
+        # number of (good) observations of target during the night containing timeof
+        if timeof == None: timeof = datetime.datetime.utcnow()
+        if target['name'] not in self.obs_history.keys(): return 0
+        return self.obs_history[target['name']]['nights'].get(self.night_of(timeof),0)
+
     # TODO: call by minerva.takeSpectrum
     def record_observation(self,target,telescopes=None, timeof=None):
         if timeof == None: timeof = datetime.datetime.utcnow()
@@ -357,7 +662,23 @@ class scheduler:
                 '\n'         
             print(target['name']+': '+obs_string)
             target_file.write(obs_string)
+        if self.obsdb != None:
+            self.obsdb.record(target['name'],obs_start,obs_end,duration,math.degrees(alt),math.degrees(azm),obs_quality)
         obs_list = [obs_start,obs_end,duration,alt,azm,obs_quality]
+
+        # keep the in-memory history in sync with the file
+        if self.obs_history_path == self.obspath:
+            if target['name'] not in self.obs_history.keys():
+                self.obs_history[target['name']] = self.index_obs_history([])
+            history = self.obs_history[target['name']]
+            epoch = (obs_start-datetime.datetime(1970,1,1)).total_seconds()
+            ndx = np.searchsorted(history['epochs'],epoch,side='right')
+            history['obs'].insert(ndx,obs_list)
+            history['epochs'] = np.insert(history['epochs'],ndx,epoch)
+            night = self.night_of(obs_start)
+            history['nights'][night] = history['nights'].get(night,0) + 1
+            if target['last_obs'] is history['obs']: return
+
         target['last_obs'].append(obs_list)
         pass
 
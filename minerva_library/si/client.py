@@ -45,7 +45,14 @@ class SIClient (object):
 		self.port = port
 
 
-		self.buff = ""
+		# bytes received but not yet consumed by recv/recv_into
+		self.buff = bytearray ()
+		# read whatever the socket has available (up to this many bytes) at once
+		self.bufsize = 65536
+
+		# seconds to wait after an Ack before reading the command's reply. The reply is read
+		# as soon as it arrives, so no delay should be needed; set this if the server misbehaves
+		self.ackDelay = 0.0
 
 		self.sk = None
 
@@ -69,52 +76,45 @@ class SIClient (object):
 		"""
 		Receive n bytes from the server.
 
-		This method takes care of underrrun and overrun conditions and assure correct framing. The method will
-		ask socket for n bytes and make sure that the return value contain exactly this amount of bytes.
+		This method takes care of underrrun and overrun conditions and assure correct framing. Whatever
+		the socket has available is appended to a bytearray buffer, so consecutive small packets (e.g.
+		an Ack and its Data) usually arrive in a single system call. Exactly n bytes are returned and
+		the rest stay buffered for the next packet.
 		"""
 
-		if len(self.buff) > 0:
-			pass
-#			logging.warning("Buffer not empty...")
-
-		# if buffer isn't empty, return it and clear it
-		bytes_to_receive = n - len(self.buff)
-
-		bytes_received = self.buff
-		self.buff = ""
-
-		retries = 0
+		while len(self.buff) < n:
+			this_try = self.sk.recv (max(n - len(self.buff), self.bufsize))
+			if not this_try:
+				raise socket.error ("connection closed by server")
+			self.buff += this_try
 
-#		print("bytes to receive %d (received %d)"%(bytes_to_receive,len(bytes_received)))
-#		logging.info("bytes to receive %d (received %d)"%(bytes_to_receive,len(bytes_received)))
+		ret = bytes (self.buff[:n])
+		del self.buff[:n]
 
-		while bytes_to_receive > 0:
-
-#			print ("bytes to receive %d" % bytes_to_receive)
-#			logging.info ("bytes to receive %d" % bytes_to_receive)
-			this_try = self.sk.recv (bytes_to_receive)
+		return ret
 
-#			print ("bytes received on this try %d" % len(this_try))
-#			logging.info ("bytes received on this try %d" % len(this_try))
-			bytes_to_receive -= len (this_try)
+	def recv_into (self, view):
+		"""
+		Receive len(view) bytes from the server directly into a writable buffer.
 
-			bytes_received += this_try
-			retries += 1
+		view is typically a memoryview slice of a preallocated array, so no intermediate strings are
+		created. Bytes left over in the framing buffer by recv are consumed first.
+		"""
 
-		ret = ""
+		n = len(view)
 
-		if len(bytes_received) > n:
-			# we received more then one packet, get the packet and put the rest on a buffer
-			self.buff = bytes_received[n:]
-			ret = bytes_received[:n]
-#			logging.warning("buffer overrrun")
-		else:
-			ret = bytes_received
+		received = min(len(self.buff), n)
+		if received > 0:
+			view[:received] = self.buff[:received]
+			del self.buff[:received]
 
-#                print ret
-#		logging.info ("> framing retries %d (return length %d)" % (retries, len(ret)))
+		while received < n:
+			this_try = self.sk.recv_into (view[received:], n - received)
+			if this_try == 0:
+				raise socket.error ("connection closed by server")
+			received += this_try
 
-		return ret
+		return received
 		
 		
 	def executeCommand (self, cmd, noAck=False):
@@ -142,7 +142,11 @@ class SIClient (object):
 		while True:
 			
 #			print 'receiving package'
-			ret = select.select ([self.sk], [], [])
+			# only wait on the socket if we don't already have the next packet buffered
+			if len(self.buff) > 0:
+				ret = ([self.sk], [], [])
+			else:
+				ret = select.select ([self.sk], [], [])
 
 			if not ret[0]:
 				break
@@ -161,9 +165,9 @@ class SIClient (object):
 					ack = Ack ()                  
 					ack.fromStruct (header_data + self.recv (header.length - len(header)))                    
 #					logging.debug (ack)
-					# TODO: Figure out why do I need this sleep here. If I don't do this, some commands are not
-					# TODO: performed. I really don't know why!
-					time.sleep(0.1)
+					# we keep reading until the Data packet arrives, so the fixed 0.1 s sleep that
+					# used to be here isn't needed (see ackDelay)
+					if self.ackDelay > 0: time.sleep(self.ackDelay)
 					#return ack
 					if not ack.accept:
 						 raise AckException("Camera did not accepted command...")
@@ -205,21 +209,31 @@ class SIClient (object):
 
 					img = cmd.result ()
 					img.fromStruct (header_data + self.recv (len(img) - len(header)))
+#					logging.debug (img)
 
+					# preallocate the whole frame from the header and read each
+					# packet's pixels straight into it
 					# TODO: Needs better mapping of types here!
-					tmp_array = np.fromstring(self.recv(img.img_bytes),np.uint16)
-#					logging.debug (img)
+					frame = np.empty (img.serial_length*img.parallel_length, np.uint16)
+					nbytes = 0
+
+					for i in range (img.total_packets):
+
+						if i > 0:
+							data = self.recv (len(img))
+							img.fromStruct (data)
+							#logging.debug (img)
 
-					packets = img.total_packets - 1
-				   
-					for i in range (packets):
+						if nbytes + img.img_bytes > frame.nbytes:
+							# more data than the header promised; grow the frame
+							grown = np.empty ((nbytes + img.img_bytes + 1)//2, np.uint16)
+							grown[:nbytes//2] = frame[:nbytes//2]
+							frame = grown
 
-						data = self.recv (len(img))
-						img.fromStruct (data)
-						#logging.debug (img)
-						data = self.recv(img.img_bytes)
-						tmp_array = np.append(tmp_array,np.fromstring(data,np.uint16))
+						view = memoryview (frame.view(np.uint8))
+						self.recv_into (view[nbytes:nbytes+img.img_bytes])
+						nbytes += img.img_bytes
 			
-					return (img.serial_length, img.parallel_length, tmp_array)
+					return (img.serial_length, img.parallel_length, frame[:nbytes//2])
 		
 				
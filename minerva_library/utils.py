@@ -6,6 +6,7 @@ try:
 except:
     from astropy.io import fits as pyfits
 import numpy as np
+import math
 import ephem
 import datetime, time
 import ipdb
@@ -83,12 +84,47 @@ def readcsv(filename):
             except: csv[key] = np.asarray(csv[key])
         return csv
 
+# bright star catalogs already loaded by this process, keyed by file name
+_brightstarcache = {}
+
+# returns the bright star catalog as a numpy structured array (one field
+# per CSV column), sorted by declination for brightStarsInRegion. The CSV
+# is parsed once per process; a binary copy (filename + '.npy') is saved
+# next to it and memory-mapped on later runs as long as it is newer than
+# the CSV
+def brightStarCatalog(filename='bsc.csv',path='/home/minerva/minerva-control/dependencies/'):
+    csvfile = path + filename
+    npyfile = csvfile + '.npy'
+    mtime = os.path.getmtime(csvfile)
+
+    cached = _brightstarcache.get(csvfile)
+    if cached != None and cached[0] == mtime: return cached[1]
+
+    catalog = None
+    if os.path.exists(npyfile) and os.path.getmtime(npyfile) >= mtime:
+        try: catalog = np.load(npyfile, mmap_mode='r')
+        except: catalog = None
+
+    if catalog is None:
+        columns = readcsv(csvfile)
+        keys = sorted(columns.keys())
+        catalog = np.empty(len(columns[keys[0]]), dtype=[(str(key),columns[key].dtype) for key in keys])
+        for key in keys: catalog[str(key)] = columns[key]
+        catalog = catalog[np.argsort(catalog['dec'],kind='mergesort')]
+        # the binary copy is only an optimization; don't fail if the directory isn't writable
+        try: np.save(npyfile, catalog)
+        except: pass
+
+    _brightstarcache[csvfile] = (mtime, catalog)
+    return catalog
+
 def brightStars(filename='bsc.csv',path='/home/minerva/minerva-control/dependencies/',maxmag=6.0):
 #def brightStars(filename='brightstars2.csv',path='/home/minerva/minerva-control/dependencies/',maxmag=6.0):
-    brightstars = readcsv(path+filename)
-    brightest = np.where(brightstars['vmag'] <= maxmag)
-    for key in brightstars.keys():
-        brightstars[key] = brightstars[key][brightest]
+    catalog = brightStarCatalog(filename=filename,path=path)
+    brightest = np.where(catalog['vmag'] <= maxmag)
+    brightstars = {}
+    for key in catalog.dtype.names:
+        brightstars[key] = catalog[key][brightest]
 
     '''
     # cut out high proper motion stars
@@ -100,6 +136,47 @@ def brightStars(filename='bsc.csv',path='/home/minerva/minerva-control/dependenc
 
     return brightstars
 
+# returns the bright stars (a structured array, as brightStarCatalog)
+# within an alt/az region at local sidereal time lst (hours) and
+# latitude (degrees). Stars that can never reach minalt are excluded
+# with a binary search on the dec-sorted catalog before the rest are
+# converted to alt/az. The conversion uses catalog (J2000) coordinates
+# without precession or refraction, so it is only good to ~0.5 degrees;
+# pad the region accordingly and check the selected stars precisely
+def brightStarsInRegion(lst, latitude, minalt=0.0, maxalt=90.0, minaz=0.0, maxaz=360.0, maxmag=6.0,
+                        filename='bsc.csv',path='/home/minerva/minerva-control/dependencies/'):
+    catalog = brightStarCatalog(filename=filename,path=path)
+
+    # the magnitude cut and the trig terms that don't depend on time are
+    # computed once per catalog and maxmag
+    key = (path + filename, maxmag)
+    index = _brightstarcache.get(key)
+    if index == None or index['catalog'] is not catalog:
+        stars = catalog[np.where(catalog['vmag'] <= maxmag)]
+        dec = np.radians(np.asarray(stars['dec'],dtype=float))
+        index = {'catalog':catalog, 'stars':stars,
+                 'dec':np.degrees(dec),
+                 'ra':np.radians(np.asarray(stars['ra'],dtype=float)*15.0),
+                 'sindec':np.sin(dec), 'cosdec':np.cos(dec)}
+        _brightstarcache[key] = index
+
+    # a star at dec transits at an altitude of 90 - |dec - latitude|
+    first, last = np.searchsorted(index['dec'], [latitude - (90.0 - minalt), latitude + (90.0 - minalt)])
+    sindec = index['sindec'][first:last]
+    cosdec = index['cosdec'][first:last]
+    ha = np.radians(lst*15.0) - index['ra'][first:last]
+    cosha = np.cos(ha)
+
+    lat = np.radians(latitude)
+    sinalt = sindec*np.sin(lat) + cosdec*np.cos(lat)*cosha
+    alt = np.degrees(np.arcsin(np.clip(sinalt,-1.0,1.0)))
+    az = np.degrees(np.arctan2(-cosdec*np.sin(ha), sindec*np.cos(lat) - cosdec*np.sin(lat)*cosha)) % 360.0
+
+    inregion = (alt >= minalt) & (alt <= maxalt)
+    if minaz <= maxaz: inregion &= (az >= minaz) & (az <= maxaz)
+    else: inregion &= (az >= minaz) | (az <= maxaz) # region wraps through north
+    return index['stars'][first:last][inregion]
+
 def parseTarget(line, logger=None):
     try:
         target = json.loads(line)
@@ -300,38 +377,65 @@ def setup_logger(base_dir, night, logger_name):
 
     return logger
 
-# Truncates target['starttime'] and target['endtime'] to ensure 
-# the object is observable (Sun below sunalt and target above horizon)
-def truncate_observable_window(site,target,sunalt=-12.0,horizon=21.0,timeof=None,logger=None):
+# polls predicate() until it returns True (returns True) or timeout
+# seconds pass (returns False). Without an expected completion time, the
+# polling interval starts at mininterval and grows by a factor of backoff
+# up to maxinterval, so short waits are noticed quickly and long waits
+# don't hammer the hardware. If expected (seconds from now) is given, each
+# sleep is half the time left until then, so polling tightens to
+# mininterval right around the expected completion and backs off again
+# only if it runs late
+def wait_until(predicate, timeout, expected=None, mininterval=0.1, maxinterval=1.0, backoff=1.5):
+    t0 = time.time()
+    interval = mininterval
+    while True:
+        if predicate(): return True
+        elapsed = time.time() - t0
+        remaining = timeout - elapsed
+        if remaining <= 0: return False
+
+        if expected != None and elapsed < expected:
+            sleeptime = min(maxinterval, max(mininterval, (expected-elapsed)/2.0))
+        else:
+            sleeptime = interval
+            interval = min(interval*backoff, maxinterval)
+        time.sleep(min(sleeptime, remaining))
+
+# nights already computed by observable_night, keyed by site and sunalt:
+# (previous sunrise, sunset, sunrise)
+_nightcache = {}
+
+# returns the sunset and sunrise (Sun at sunalt) bounding the night
+# that contains timeof, or the next night if timeof is during the day.
+# Returns None if they can't be determined. Every timeof between the
+# previous sunrise and this sunrise gives the same night, so each
+# night's boundaries are only computed once
+def observable_night(site,sunalt=-12.0,timeof=None,logger=None):
 
     if timeof == None: timeof = datetime.datetime.utcnow()
 
-    sunset = site.sunset(horizon=sunalt, start=timeof)
-    sunrise = site.sunrise(horizon=sunalt, start=timeof)
+    key = (id(site), sunalt)
+    cached = _nightcache.get(key)
+    if cached != None and cached[0] < timeof and timeof <= cached[2]:
+        return cached[1], cached[2]
 
-    niter = 0
-    while sunrise < timeof and niter < 100:
-        sunrise = site.sunrise(horizon=sunalt, start=timeof + datetime.timedelta(days=0.1*niter))
-        niter += 1
-    if sunrise < timeof:
-        if logger <> None: logger.error("Error calculating nearest sunrise")
+    try:
+        sunrise = site.sunrise(horizon=sunalt, start=timeof)
+        site.obs.horizon = str(sunalt)
+        sunset = site.obs.previous_setting(ephem.Sun(), start=sunrise, use_center=True).datetime()
+        prevsunrise = site.obs.previous_rising(ephem.Sun(), start=sunset, use_center=True).datetime()
+    except (ephem.AlwaysUpError, ephem.NeverUpError):
+        if logger <> None: logger.error("Error calculating the nearest sunset and sunrise")
         return
 
-    niter = 0
-    while sunset > sunrise and niter < 100:
-        sunset = site.sunset(horizon=sunalt, start=timeof - datetime.timedelta(days=0.1*niter))
-        niter += 1
-    if sunset > sunrise:
-        if logger <> None: logger.error("Error calculating nearest sunset. Sunset = " + str(sunset) + ' sunrise = ' + str(sunrise))
-        return
-        
-    site.obs.horizon = str(horizon)
-    body = ephem.FixedBody()
-    body._ra = ephem.hours(str(target['ra']))
-    body._dec = ephem.degrees(str(target['dec']))
+    _nightcache[key] = (prevsunrise, sunset, sunrise)
+    return sunset, sunrise
 
-    #S UTC vs local time not right for epoch, but not significant
-    body._epoch = timeof#datetime.datetime.utcnow()
+# rise and set times of body (see rise_set_times), found with ephem's
+# own (iterative) search
+def _rise_set_times_ephem(site,body,sunset,sunrise,horizon=21.0):
+
+    site.obs.horizon = str(horizon)
     body.compute()
 
     # calculate the object's rise time
@@ -367,10 +471,98 @@ def truncate_observable_window(site,target,sunalt=-12.0,horizon=21.0,timeof=None
             risetime = sunrise
         niter += 1
 
-#    if risetime > settime:
-#        if logger <> None: logger.error("Error calculating risetime (" + str(risetime) + ") and settime (" + str(settime) + ")")
-#        ipdb.set_trace()
-#        return
+    return risetime, settime
+
+# observer (a copy of site.obs at sunset) and the local sidereal time at
+# sunset (radians) for the last night rise_set_times was called for
+_sunsetcache = {}
+
+# returns the times target rises above and sets below horizon during the
+# night between sunset and sunrise (from observable_night). Targets that
+# are always up get sunset, sunrise; targets that are never up get
+# sunrise, sunset (an empty window). If the target is already up at
+# sunset, the rise time is the rise before sunset.
+# The hour angle at which the target crosses the horizon is computed in
+# closed form and the times follow from the sidereal time at sunset.
+# That ignores refraction, nutation and aberration, so each time is then
+# refined with Newton steps on the apparent altitude from ephem (one or
+# two computes), which agrees with next_rising/next_setting to well
+# under a second
+def rise_set_times(site,target,sunset,sunrise,horizon=21.0,timeof=None):
+
+    if timeof == None: timeof = datetime.datetime.utcnow()
+
+    key = id(site)
+    cached = _sunsetcache.get(key)
+    if cached == None or cached[0] != sunset:
+        obs = site.obs.copy()
+        obs.date = sunset
+        cached = (sunset, obs, float(obs.sidereal_time()))
+        _sunsetcache[key] = cached
+    obs, lst = cached[1:]
+
+    body = ephem.FixedBody()
+    body._ra = ephem.hours(str(target['ra']))
+    body._dec = ephem.degrees(str(target['dec']))
+    #S UTC vs local time not right for epoch, but not significant
+    body._epoch = timeof#datetime.datetime.utcnow()
+
+    lat = float(obs.lat)
+    dec = float(body._dec)
+    alt = math.radians(horizon)
+
+    # geometric altitude at which the apparent (refracted) altitude is horizon (Bennett 1982)
+    refraction = math.radians(1.02/math.tan(math.radians(horizon + 10.3/(horizon + 5.11)))/60.0)
+    refraction *= (obs.pressure/1010.0)*(283.0/(273.0 + obs.temp))
+    geoalt = alt - refraction
+
+    # targets that barely reach (or barely clear) the horizon depend on
+    # details the closed form ignores; let ephem search for those
+    maxalt = math.pi/2.0 - abs(lat - dec)
+    minalt = abs(lat + dec) - math.pi/2.0
+    if abs(maxalt - geoalt) < math.radians(0.1) or abs(minalt - geoalt) < math.radians(0.1):
+        return _rise_set_times_ephem(site,body,sunset,sunrise,horizon=horizon)
+
+    cosha = (math.sin(geoalt) - math.sin(lat)*math.sin(dec))/(math.cos(lat)*math.cos(dec))
+    if cosha < -1.0: return sunset, sunrise # always up
+    if cosha > 1.0: return sunrise, sunset  # never up
+    ha = math.acos(cosha)
+
+    # hour angle of the target at sunset, and the sidereal rate (radians/second)
+    hasunset = lst - float(body._ra)
+    rate = 2.0*math.pi*1.00273790935/86400.0
+
+    # refine the time (seconds after sunset) at which the target crosses the horizon
+    def crossing(seconds):
+        for i in range(6):
+            obs.date = sunset + datetime.timedelta(seconds=seconds)
+            body.compute(obs)
+            # d(alt)/dt = -rate*cos(lat)*cos(dec)*sin(ha)/cos(alt)
+            altrate = -rate*math.cos(lat)*math.cos(dec)*math.sin(float(obs.sidereal_time()) - float(body.ra))/math.cos(float(body.alt))
+            if altrate == 0.0: break
+            step = max(min((alt - float(body.alt))/altrate, 600.0), -600.0)
+            seconds += step
+            if abs(step) < 0.1: break
+        return sunset + datetime.timedelta(seconds=seconds)
+
+    setseconds = ((ha - hasunset) % (2*math.pi))/rate
+    riseseconds = ((-ha - hasunset) % (2*math.pi))/rate
+    # if it rises after it sets, it was already up at sunset; use the previous rise
+    if riseseconds > setseconds: riseseconds -= 2*math.pi/rate
+
+    return crossing(riseseconds), crossing(setseconds)
+
+# Truncates target['starttime'] and target['endtime'] to ensure 
+# the object is observable (Sun below sunalt and target above horizon)
+def truncate_observable_window(site,target,sunalt=-12.0,horizon=21.0,timeof=None,logger=None):
+
+    if timeof == None: timeof = datetime.datetime.utcnow()
+
+    night = observable_night(site,sunalt=sunalt,timeof=timeof,logger=logger)
+    if night == None: return
+    sunset, sunrise = night
+
+    risetime, settime = rise_set_times(site,target,sunset,sunrise,horizon=horizon,timeof=timeof)
 
     # the start time should be the later of the requested start time, when the target rises, or when the sun sets
     starttime = max(target['starttime'],risetime,sunset) 
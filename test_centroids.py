@@ -0,0 +1,59 @@
+#checks get_all_centroids.centroid_all_blobs against the original
+#implementation (which grew its output with np.vstack per blob) on
+#simulated star fields
+import sys
+sys.dont_write_bytecode = True
+from minerva_library import get_all_centroids
+import numpy as np
+import cv2
+
+# centroid_all_blobs as it was before it collected rows in a list
+def centroid_all_blobs_vstack(thresholded_image, areacutoff=30):
+	thresholded_copy = thresholded_image.copy()
+	contours,hierarchy = cv2.findContours(thresholded_copy,
+					      cv2.RETR_LIST,
+					      cv2.CHAIN_APPROX_SIMPLE)
+	if len(contours)==0:
+		return np.zeros((1, 3))
+	else:
+		outarray = np.zeros((1, 3))
+		for cnt in contours:
+			M = cv2.moments(cnt)
+			if M['m00']<areacutoff:
+				continue
+			cx,cy,ssum = (M['m10']/M['m00']), (M['m01']/M['m00']), M['m00']
+			outarray=np.vstack((outarray, np.array((cx, cy, ssum))))
+	return outarray[1:,:]
+
+# gaussian stars on a noisy sky, thresholded the way the acquisition
+# images are (binary, uint8)
+def star_field(nstars, size=1024, fwhm=4.0, sky=1000.0):
+	image = np.random.normal(sky, np.sqrt(sky), (size,size))
+	sigma = fwhm/2.355
+	yy, xx = np.indices((21,21)) - 10.0
+	for i in range(nstars):
+		x0, y0 = np.random.uniform(10, size-11, 2)
+		flux = 10.0**np.random.uniform(4.0,6.0)
+		ix, iy = int(x0), int(y0)
+		psf = np.exp(-((xx-(x0-ix))**2 + (yy-(y0-iy))**2)/(2.0*sigma**2))
+		image[iy-10:iy+11,ix-10:ix+11] += flux*psf/psf.sum()
+	image = np.clip(image, 0, 65535)
+	level = sky + 5.0*get_all_centroids.robust_std(image)
+	return ((image > level)*255).astype('uint8')
+
+if __name__ == '__main__':
+
+	np.random.seed(0)
+	for nstars in [0,1,10,100,1000]:
+		for i in range(3):
+			thresholded = star_field(nstars)
+			for areacutoff in [1,30]:
+				new = get_all_centroids.centroid_all_blobs(thresholded, areacutoff=areacutoff)
+				old = centroid_all_blobs_vstack(thresholded, areacutoff=areacutoff)
+				assert new.shape == old.shape, 'nstars=%i: shape %r != %r' % (nstars,new.shape,old.shape)
+				assert np.array_equal(new, old), 'nstars=%i: centroids differ' % nstars
+		print('centroid_all_blobs matches the original with ' + str(nstars) + ' stars (' + str(len(new)) + ' blobs)')
+
+	# nothing above the threshold
+	blank = np.zeros((100,100),dtype='uint8')
+	assert np.array_equal(get_all_centroids.centroid_all_blobs(blank), centroid_all_blobs_vstack(blank))
@@ -0,0 +1,37 @@
+#checks that fau.StreamingFilter (used by the guide loop) gives the same
+#smoothed value as fau.filterdata convolving the full history
+import sys
+sys.dont_write_bytecode = True
+from minerva_library import fau
+import numpy as np
+
+# fau.filterdata as it was before it only looked at the last N samples
+def filterdata_full(vals, N=5):
+	vals = np.asarray(vals)
+	if vals.size < N:
+		return vals[-1]
+	else:
+		kernel=np.ones(N)/N
+		return np.convolve(vals, kernel, 'valid')[-1]
+
+if __name__ == '__main__':
+
+	np.random.seed(0)
+	filterdata = fau.fau.filterdata.im_func
+
+	ntests = 0
+	for N in [1,2,3,5,8]:
+		for i in range(20):
+			# guide errors (pixels), with the occasional outlier
+			history = np.random.normal(0.0,np.random.uniform(0.1,5.0),np.random.randint(1,200))
+			history[np.random.uniform(size=history.size) < 0.02] *= 50.0
+
+			streaming = fau.StreamingFilter(N)
+			for j in range(history.size):
+				value = streaming.update(history[j])
+				expected = filterdata_full(history[:j+1],N)
+				assert value == expected, 'N=%i, sample %i: %r != %r' % (N,j,value,expected)
+				assert filterdata(None,history[:j+1],N) == expected
+				ntests += 1
+
+	print 'StreamingFilter matches the full convolution (' + str(ntests) + ' samples)'
@@ -0,0 +1,73 @@
+#checks that commands served without camera_lock (imager_server.readonly_commands)
+#don't touch the camera while a locked command (e.g., save_image) is running:
+#get_status against a camera that fails until reconnected, and a command
+#that reads the last image
+import sys
+sys.dont_write_bytecode = True
+from minerva_library import imager_server
+import threading
+import logging
+import time
+
+# a camera whose properties fail until it has been reconnected
+class failing_camera:
+	def __init__(self):
+		self.connected = False
+	def __getattr__(self, name):
+		if not self.connected: raise Exception('camera not connected')
+		return 1
+
+class stub_server(imager_server.server):
+	def __init__(self):
+		self.logger = logging.getLogger('test_imager_server')
+		self.camera_lock = threading.RLock()
+		self.cam = failing_camera()
+		self.file_name = ''
+		self.guider_file_name = ''
+		self.events = []
+
+	def connect_camera(self):
+		self.events.append(('connect_camera',time.time()))
+		self.cam.connected = True
+		return 'success'
+
+	def getMean(self,guider=False):
+		self.events.append(('getMean',time.time()))
+		return 'success 0.0'
+
+# holds camera_lock for duration seconds, as a long save_image would
+def locked_command(server, duration, started):
+	with server.camera_lock:
+		started.set()
+		time.sleep(duration)
+		server.events.append(('locked command done',time.time()))
+
+def run_during_locked_command(server, command, duration=1.0):
+	started = threading.Event()
+	thread = threading.Thread(target=locked_command,args=(server,duration,started))
+	thread.start()
+	started.wait()
+	response = server.execute_command(command)
+	server.events.append(('answered',time.time()))
+	thread.join()
+	return response
+
+if __name__ == '__main__':
+
+	logging.basicConfig(level=logging.CRITICAL)
+
+	for command in ['get_status none','getMean none']:
+		server = stub_server()
+		response = run_during_locked_command(server, command)
+		assert response.split()[0] == 'success', command + ': ' + response
+		names = [event[0] for event in server.events]
+		assert names[0] == 'locked command done', command + ' touched the camera during the locked command: ' + str(names)
+		print command + ' waited for the locked command: ' + str(names)
+
+	# a healthy camera is read without waiting for the lock
+	server = stub_server()
+	server.cam.connected = True
+	response = run_during_locked_command(server, 'get_status none')
+	names = [event[0] for event in server.events]
+	assert response.split()[0] == 'success' and names[0] == 'answered', str(names)
+	print 'get_status of a connected camera answered during the locked command: ' + str(names)
@@ -0,0 +1,54 @@
+#checks that scheduler.calculate_weights gives the same weights and
+#observing windows from the vectorized target table as from the original
+#loop over targets, every half hour through tonight
+import sys
+sys.dont_write_bytecode = True
+from minerva_library import scheduler
+import datetime
+import os
+
+# weights and windows of every target, the loop way and the table way
+def compare_weights(sched, timeof, cadence=True):
+
+	# the loop (and calc_weight_multi) prints a line per target
+	stdout = sys.stdout
+	sys.stdout = open(os.devnull,'w')
+	try:
+		sched.calculate_weights(timeof=timeof,cadence=cadence,vectorized=False)
+		loop = [(target['weight'],target['starttime'],target['endtime']) for target in sched.target_list]
+		loop_start_ha = sched.start_ha
+		sched.calculate_weights(timeof=timeof,cadence=cadence,vectorized=True)
+		table = [(target['weight'],target['starttime'],target['endtime']) for target in sched.target_list]
+	finally:
+		sys.stdout.close()
+		sys.stdout = stdout
+
+	for target,a,b in zip(sched.target_list,loop,table):
+		assert a[1:] == b[1:], target['name'] + ': window ' + str(a[1:]) + ' != ' + str(b[1:])
+		if target['bstar'] and not sched.bstarobserved and a[0] != -999.0:
+			# scaled by the time left in the night, from utcnow() on each call
+			assert abs(a[0]-b[0]) <= 1e-3*abs(a[0]), target['name'] + ': weight ' + str(a[0]) + ' != ' + str(b[0])
+		else:
+			assert a[0] == b[0], target['name'] + ': weight ' + str(a[0]) + ' != ' + str(b[0])
+	if cadence: assert loop_start_ha == sched.start_ha
+
+	return len([x for x in table if x[0] != -999.0])
+
+if __name__ == '__main__':
+
+	base_directory = '/home/minerva/minerva-control'
+	red = len(sys.argv) == 2 and sys.argv[1] == 'red'
+	sched = scheduler.scheduler('scheduler.ini',base_directory,red=red)
+
+	if not sched.calc_observability():
+		print 'No observable night found'
+		sys.exit()
+	sunset, sunrise = sched.observability_night[1:]
+	sched.prep_night(timeof=sunset)
+
+	timeof = sunset
+	while timeof < sunrise:
+		for cadence in [True,False]:
+			nobservable = compare_weights(sched, timeof, cadence=cadence)
+		print str(timeof) + ': weights match for ' + str(len(sched.target_list)) + ' targets (' + str(nobservable) + ' observable)'
+		timeof += datetime.timedelta(minutes=30)